@@ -4,12 +4,12 @@ from flask import Flask
 from flask.ext.socketio import SocketIO
 from flask.ext.babel import Babel
 from flask.ext.babel import lazy_gettext
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.mail import Mail
 from flask.ext.login import LoginManager
 from flask.ext.admin import Admin
 from flask.json import JSONEncoder
 from config import config
+from .database import SQLAlchemy
 
 
 mail = Mail()
@@ -5,7 +5,7 @@ from wtforms import PasswordField
 from sqlalchemy.orm.attributes import get_history
 
 from ..models import Sensor, SensorType, Device, Contact, Notification, Relay, User
-from .. import admin, db
+from .. import admin, db, sensor_registry
 
 
 class MyView(ModelView):
@@ -16,6 +16,22 @@ class MyView(ModelView):
         if not self.is_accessible():
             return redirect(url_for('auth.login', next=request.url))
 
+    # Sensor snapshots in the registry may depend on any of the models, so drop them after a successful save
+    def create_model(self, form):
+        result = super(MyView, self).create_model(form)
+        sensor_registry.invalidate()
+        return result
+
+    def update_model(self, form, model):
+        result = super(MyView, self).update_model(form, model)
+        sensor_registry.invalidate()
+        return result
+
+    def delete_model(self, model):
+        result = super(MyView, self).delete_model(model)
+        sensor_registry.invalidate()
+        return result
+
 
 class UserView(MyView):
     column_list = ('email', 'password', 'last_seen', 'locale')
@@ -9,4 +9,5 @@ class LoginForm(Form):
     password = PasswordField(lazy_gettext('Password'), validators=[Required()])
     remember_me = BooleanField(lazy_gettext('Keep me logged in'))
     charts_enabled = BooleanField(lazy_gettext('Enable charts'), default=True)
+    compact_data = BooleanField(lazy_gettext('Compact data (slow connections)'), default=False)
     submit = SubmitField(lazy_gettext('Log In'))
\ No newline at end of file
@@ -24,6 +24,7 @@ def login():
             redirect_next = redirect(request.args.get('next') or url_for('dashboard.index'))
             response = current_app.make_response(redirect_next)
             response.set_cookie('charts_enabled', value='T' if form.charts_enabled.data else 'F')
+            response.set_cookie('series_encoding', value='f32' if form.compact_data.data else 'json')
             return response
         flash(gettext('Invalid username or password.'))
     return render_template('auth/login.html', form=form)
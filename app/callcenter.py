@@ -1,119 +1,200 @@
-from time import sleep
+from time import time
 import threading
 
 from flask import current_app
-from twilio import TwilioRestException
 from twilio.rest import TwilioRestClient
-from . import thread_monitor
+from . import thread_monitor, notification_dispatcher
 
+clients_lock = threading.Lock()
+clients = {}
 
-def get_call_thread_name(to):
-    return 'Calling %s' % (to,)
 
+def get_client(sid, token):
+    """ Returns Twilio client shared by everyone using the same account
+    """
+    with clients_lock:
+        client = clients.get((sid, token))
+        if client is None:
+            client = clients[(sid, token)] = TwilioRestClient(sid, token)
+    return client
+
+
+class Call(object):
+    """ Call in progress to one contact (phone number), repeated until it is seen or max attempts are reached
+    """
+
+    def __init__(self, to, call_finished_callback, args):
+        self.to = to
+        self.call_finished_callback = call_finished_callback
+        self.args = args
+        self.sid = None
+        self.nr_attempts = 0
+        self.cancel_requested = False
+        self.next_poll_ts = 0
+        self.poll_interval = None
 
-def get_calls_in_progress():
-    thread_names = [t.name for t in threading.enumerate() if t.name.startswith('Calling ')]
-    calls = []
-    for tn in thread_names:
-        thread = thread_monitor.get_thread(tn)
-        if thread is not None:
-            calls.append({
-                'id': thread.args[0]
-            })
 
-    return calls
+calls_lock = threading.Lock()
+calls = {}
+calls_changed = threading.Event()
+
+
+def start():
+    if current_app.config['MAKE_CALLS']:
+        thread_monitor.start_thread('Call supervisor', restart_on_exit=True, target=_supervise_calls)
+
+
+def get_calls_in_progress():
+    with calls_lock:
+        return [{'id': to} for to in calls]
 
 
 def cancel_call(to):
-    thread_name = get_call_thread_name(to)
-    current_app.logger.info('Finding a call in progress to cancel (%s)!' % (thread_name,))
-    thread = thread_monitor.get_thread(thread_name)
-    if thread is not None:
-        current_app.logger.info('Canceling call in progress (%s)!' % (thread_name,))
-        thread.args[2].set()
+    current_app.logger.info('Finding a call in progress to cancel (%s)!' % (to,))
+    with calls_lock:
+        call = calls.get(to)
+        if call is not None:
+            current_app.logger.info('Canceling call in progress (%s)!' % (to,))
+            call.cancel_requested = True
+            call.next_poll_ts = 0
+    calls_changed.set()
 
 
 def make_a_call(to, start_call_callback, call_finished_callback, args):
-    log_msg = get_call_thread_name(to)
-    current_app.logger.info(log_msg)
+    current_app.logger.info('Calling %s' % (to,))
 
     if not current_app.config['MAKE_CALLS']:
         current_app.logger.exception('Calling disabled')
-    else:
-        if thread_monitor.any_threads_by_name(log_msg):
-            current_app.logger.info('Call in progress (%s), skip call!' % (log_msg,))
-        else:
-            start_call_callback(to, *args)
-            cancel_event = threading.Event()
-            thread_monitor.start_thread(log_msg, False, _make_a_call, (to, call_finished_callback, cancel_event, args))
-
-
-def _make_a_call(to, call_finished_callback, cancel_event, args):
-    client = TwilioRestClient(current_app.config['TWILIO_SID'],
-                              current_app.config['TWILIO_TOKEN'])
-    try:
-        call_successful = False
-        nr_attempts = 0
-        max_attempts = 30
-        while not call_successful and nr_attempts < max_attempts:
-            nr_attempts += 1
-            call = client.calls.create(to=to, from_=current_app.config['TWILIO_FROM_PHONE'],
-                                       url=current_app.config["TWILIO_CALL_TWIML"])
-            current_app.logger.info('Call (SID %s, TO %s) attempt nr %d/%d' % (call.sid, to, nr_attempts, max_attempts))
-
-            # check what is happening with the call
-            call_is_ended = False
-            while not call_is_ended:
-                call_info = client.calls.get(call.sid)
-
-                # If call has to be canceled
-                if cancel_event.is_set():
-                    call_successful = True
-                    client.calls.update(call.sid, status="completed")
-                    current_app.logger.info('Call (SID %s, TO %s) canceled "%s"' % (call.sid, to, call_info.status))
-                    break
-
-                # Call had been seen
-                if call_info.status in ('canceled', 'completed', 'in-progress'):
-                    call_successful = True
-                    current_app.logger.info('Call (SID %s, TO %s) successful "%s"' % (call.sid, to, call_info.status))
-                    break
-
-                # Call could not be made
-                if call_info.status in ('busy', 'no-answer', 'failed'):
-                    call_successful = False
-                    current_app.logger.info(
-                        'Call (SID %s, TO %s) NOT successful "%s"' % (call.sid, to, call_info.status))
-                    break
-
-                # Else check again
-                sleep(3)
-
-    except TwilioRestException as e:
-        current_app.logger.exception(e)
-    else:
-        current_app.logger.info('Call to %s finished!' % (to,))
-    call_finished_callback(to, *args)
+        return
+
+    with calls_lock:
+        if to in calls:
+            current_app.logger.info('Call in progress (%s), skip call!' % (to,))
+            return
+        calls[to] = Call(to, call_finished_callback, args)
+
+    start_call_callback(to, *args)
+    calls_changed.set()
+
+
+def _supervise_calls():
+    while True:
+        with calls_lock:
+            has_calls = len(calls) > 0
+
+        next_poll_ts = None
+        if has_calls:
+            try:
+                client = get_client(current_app.config['TWILIO_SID'], current_app.config['TWILIO_TOKEN'])
+            except Exception as e:
+                current_app.logger.exception(e)
+                next_poll_ts = time() + current_app.config['CALL_POLL_MAX_SECONDS']
+            else:
+                next_poll_ts = poll_calls(client)
+        calls_changed.wait(None if next_poll_ts is None else max(0, next_poll_ts - time()))
+        calls_changed.clear()
+
+
+def poll_calls(client, now=None):
+    """ Advances all calls that are due, returns timestamp of the next due call (None if there are no calls)
+    """
+    if now is None:
+        now = time()
+    with calls_lock:
+        due = [c for c in calls.itervalues() if c.next_poll_ts <= now]
+
+    for call in due:
+        try:
+            finished = _poll_call(client, call, now)
+        except Exception as e:
+            # Twilio or connection error, do not let one call stop the others
+            current_app.logger.exception(e)
+            finished = True
+
+        if finished:
+            with calls_lock:
+                del calls[call.to]
+            current_app.logger.info('Call to %s finished!' % (call.to,))
+            try:
+                call.call_finished_callback(call.to, *call.args)
+            except Exception as e:
+                current_app.logger.exception(e)
+
+    with calls_lock:
+        if len(calls) == 0:
+            return None
+        return min(c.next_poll_ts for c in calls.itervalues())
+
+
+def _poll_call(client, call, now):
+    """ Returns True when the call is over
+    """
+    if call.sid is None:
+        if call.cancel_requested:
+            return True
+        max_attempts = current_app.config['CALL_MAX_ATTEMPTS']
+        if call.nr_attempts >= max_attempts:
+            return True
+
+        call.nr_attempts += 1
+        call.sid = client.calls.create(to=call.to, from_=current_app.config['TWILIO_FROM_PHONE'],
+                                       url=current_app.config["TWILIO_CALL_TWIML"]).sid
+        call.poll_interval = current_app.config['CALL_POLL_SECONDS']
+        call.next_poll_ts = now + call.poll_interval
+        current_app.logger.info('Call (SID %s, TO %s) attempt nr %d/%d' % (call.sid, call.to, call.nr_attempts,
+                                                                           max_attempts))
+        return False
+
+    # check what is happening with the call
+    call_info = client.calls.get(call.sid)
+
+    # If call has to be canceled
+    if call.cancel_requested:
+        client.calls.update(call.sid, status="completed")
+        current_app.logger.info('Call (SID %s, TO %s) canceled "%s"' % (call.sid, call.to, call_info.status))
+        return True
+
+    # Call had been seen
+    if call_info.status in ('canceled', 'completed', 'in-progress'):
+        current_app.logger.info('Call (SID %s, TO %s) successful "%s"' % (call.sid, call.to, call_info.status))
+        return True
+
+    # Call could not be made, try again
+    if call_info.status in ('busy', 'no-answer', 'failed'):
+        current_app.logger.info('Call (SID %s, TO %s) NOT successful "%s"' % (call.sid, call.to, call_info.status))
+        call.sid = None
+        call.next_poll_ts = now
+        return False
+
+    # Else check again later, less often the longer it rings
+    call.next_poll_ts = now + call.poll_interval
+    call.poll_interval = min(call.poll_interval * 2, current_app.config['CALL_POLL_MAX_SECONDS'])
+    return False
 
 
 def send_sms(to, text):
-    log_msg = 'Sending SMS to %s' % (to,)
-    current_app.logger.info(log_msg)
+    current_app.logger.info('Sending SMS to %s' % (to,))
     if not current_app.config['SEND_SMS']:
         current_app.logger.exception('SMS sending disabled')
     else:
-        thread_monitor.start_thread(log_msg, False, _send_sms, (to, text))
+        notification_dispatcher.submit('sms', (to, text))
 
 
-def _send_sms(to, text):
-    client = TwilioRestClient(current_app.config['TWILIO_SMS_SID'],
-                              current_app.config['TWILIO_SMS_TOKEN'])
+def _send_sms_messages(messages):
+    client = get_client(current_app.config['TWILIO_SMS_SID'], current_app.config['TWILIO_SMS_TOKEN'])
+
+    failed = []
+    for m in messages:
+        to, text = m
+        try:
+            message = client.messages.create(to=to, body=text,
+                                             from_=current_app.config['TWILIO_SMS_FROM_PHONE'])
+        except Exception as e:
+            current_app.logger.exception(e)
+            failed.append(m)
+        else:
+            current_app.logger.info('SMS sent to %s (SID: %s)' % (to, message.sid))
+    return failed
 
-    try:
-        message = client.messages.create(to=to, body=text,
-                                         from_=current_app.config['TWILIO_SMS_FROM_PHONE'])
-    except TwilioRestException as e:
-        current_app.logger.exception(e)
-    else:
-        current_app.logger.info('SMS sent to %s (SID: %s)' % (to, message.sid))
 
+notification_dispatcher.register('sms', _send_sms_messages)
@@ -1,17 +1,36 @@
 from datetime import timedelta
+from time import time
 
-from flask import current_app
+from flask import current_app, json
+from flask.ext.socketio import emit
 
 from .. import db, socketio
-from app import rrddb
+from app import rrddb, rrd_writer, metrics, thread_monitor, notification_dispatcher
 from app.hardware import serial_monitor, relay_controller
 from ..models import Relay, Notification, Contact, Sensor, SensorType
 from . import sensor_state
 from . import informer
+from . import history_cache
+from . import live_cache
+from . import emit_batcher
 from ..models_jsonapi import to_json_dict, encode_dict
 from . import socketio_namespace
 from .. import date_util as du
 from .. import callcenter
+from .. import sensor_registry
+
+
+_STAGE_HELP = 'Time spent in a stage of measurement processing'
+stage_lookup = metrics.histogram('farmcontrol_measurement_stage_seconds', _STAGE_HELP, {'stage': 'sensor_lookup'})
+stage_rrd = metrics.histogram('farmcontrol_measurement_stage_seconds', _STAGE_HELP, {'stage': 'rrd_submit'})
+stage_live_cache = metrics.histogram('farmcontrol_measurement_stage_seconds', _STAGE_HELP, {'stage': 'live_cache'})
+stage_sensor_state = metrics.histogram('farmcontrol_measurement_stage_seconds', _STAGE_HELP,
+                                       {'stage': 'sensor_state'})
+stage_notification = metrics.histogram('farmcontrol_measurement_stage_seconds', _STAGE_HELP,
+                                       {'stage': 'notification'})
+stage_db_commit = metrics.histogram('farmcontrol_measurement_stage_seconds', _STAGE_HELP, {'stage': 'db_commit'})
+stage_emit = metrics.histogram('farmcontrol_measurement_stage_seconds', _STAGE_HELP, {'stage': 'emit'})
+measurement_total = metrics.histogram('farmcontrol_measurement_seconds', 'Total time of measurement processing')
 
 
 def _cast_or_default(converter, value, default=None):
@@ -26,42 +45,141 @@ def _cast_or_default(converter, value, default=None):
 
 
 def init():
+    rrddb.check_backend()
+    rrd_writer.start()
+    emit_batcher.start()
+    notification_dispatcher.start()
+    callcenter.start()
     serial_monitor.start(process_measurement)
 
 
+def shutdown():
+    rrd_writer.flush(timeout=30)
+
+
 def process_measurement(measurement):
     try:
-        measurement.init_sensor()
+        started = t = time()
+        sensor = sensor_registry.get(measurement.sensor_code)
+        t = _observe(stage_lookup, t)
 
-        if measurement.sensor is None:
+        if sensor is None:
             raise Exception('Sensor is not defined for received measurement %s'
-                            % measurement)
-
-        if measurement.sensor.can_save_into_rrddb():
-            rrddb.add(measurement, measurement.sensor.get_rrd_definition())
-
-        warnings = sensor_state.update_and_get_warnings(measurement)
-
-        if warnings is not None and measurement.sensor.enable_warnings:
-            notification = informer.send_warnings(warnings, process_emit_call_in_progress, process_emit_call_ended)
-            db.session.add(notification)
-            db.session.commit()
-            measurement.has_notification = True
-            socketio.emit('notification update', notification.to_json_dict(), namespace=socketio_namespace)
-
-        db.session.commit()
-
-        measurement.init_has_warning()
-        socketio.emit('sensor update', measurement.to_json_dict(), namespace=socketio_namespace)
-
-        db.session.remove()
+                            % (measurement,))
+
+        if sensor.can_save_into_rrddb():
+            rrd_writer.submit(sensor.get_rrd_definition(), measurement.read_ts, measurement.value)
+            t = _observe(stage_rrd, t)
+
+        live_cache.record(sensor, measurement.read_ts, measurement.value)
+        t = _observe(stage_live_cache, t)
+
+        warnings = sensor_state.update_and_get_warnings(sensor, measurement)
+        t = _observe(stage_sensor_state, t)
+
+        has_notification = False
+        if warnings is not None and sensor.enable_warnings:
+            # the only path touching the database: a new notification and updated Contact.last_phone_call_ts
+            try:
+                notification = informer.send_warnings(warnings, process_emit_call_in_progress,
+                                                      process_emit_call_ended)
+                t = _observe(stage_notification, t)
+                db.session.add(notification)
+                db.session.commit()
+                notification_update = notification.to_json_dict()
+                t = _observe(stage_db_commit, t)
+            finally:
+                db.session.remove()
+            has_notification = True
+            socketio.emit('notification update', notification_update, namespace=socketio_namespace)
+
+        sensor_update = measurement.to_json_dict(sensor, has_notification)
+        if sensor_update['has_warning'] or has_notification:
+            emit_batcher.emit_now(sensor_update)
+        else:
+            emit_batcher.emit(sensor_update)
+        t = _observe(stage_emit, t)
+
+        measurement_total.observe(t - started)
 
     except Exception, e:
         current_app.logger.exception(e)
 
 
-def process_history_json():
-    sensors = Sensor.query.all()
+def _observe(histogram, started):
+    now = time()
+    histogram.observe(now - started)
+    return now
+
+
+# stats of the background workers that are current values, all others are counters (only grow)
+_GAUGE_STATS = frozenset(['pending', 'queue_depth', 'last_batch_size', 'max_batch_size', 'frames_per_second'])
+
+
+def _stats_metrics(prefix, description, stats):
+    samples = []
+    for name, value in sorted(stats.items()):
+        help = '%s %s' % (description, name.replace('_', ' '))
+        if name in _GAUGE_STATS:
+            samples.append(('%s_%s' % (prefix, name), help, 'gauge', value, None))
+        else:
+            samples.append(('%s_%s_total' % (prefix, name), help, 'counter', value, None))
+    return samples
+
+
+def process_metrics():
+    """ Returns stage timings, relay query latency and stats of the background workers in Prometheus text format
+    """
+    gauges = _stats_metrics('farmcontrol_rrd_writer', 'RRD writer', rrd_writer.get_stats())
+    gauges += _stats_metrics('farmcontrol_sensor_updates', 'Sensor update batcher', emit_batcher.get_stats())
+    gauges += _stats_metrics('farmcontrol_notifications', 'Notification dispatcher',
+                             notification_dispatcher.get_stats())
+    gauges += _stats_metrics('farmcontrol_serial', 'Serial LLAP', serial_monitor.get_stats())
+
+    threads = thread_monitor.get_stats()
+    gauges.append(('farmcontrol_threads', 'Running threads', 'gauge', threads['threads'], None))
+    gauges.append(('farmcontrol_calls_in_progress', 'Calls in progress', 'gauge',
+                   len(callcenter.get_calls_in_progress()), None))
+    gauges.append(('farmcontrol_thread_restart_queue_depth', 'Threads waiting for restart', 'gauge',
+                   threads['restart_queue_depth'], None))
+    for name, pool in sorted(threads['pools'].items()):
+        gauges.append(('farmcontrol_pool_workers', 'Worker pool threads', 'gauge', pool['workers'],
+                       {'pool': name}))
+    for name, pool in sorted(threads['pools'].items()):
+        gauges.append(('farmcontrol_pool_queue_depth', 'Worker pool queued tasks', 'gauge', pool['queue_depth'],
+                       {'pool': name}))
+
+    return metrics.render(gauges)
+
+
+def process_history_json(points=None, encoding=None):
+    return _build_history_json(_fetch_history(), points, encoding)
+
+
+def process_history_body(points=None, encoding=None):
+    """ Returns history JSON body (see history_cache.CachedBody), rebuilt only when any series changed,
+    points limits the number of values per series (rounded up to a multiple of 100, HISTORY_MAX_POINTS at most),
+    with encoding 'f32' series are packed (see RrdFetchResults.to_binary_dict)
+    """
+    if points is not None:
+        points = min(max(100, (points + 99) // 100 * 100), current_app.config['HISTORY_MAX_POINTS'])
+    history = _fetch_history()
+    version = (sensor_registry.generation(),
+               tuple((s.id, results.from_ts, results.to_ts) for s, results in history))
+    return history_cache.get_body((points, encoding), version,
+                                  lambda: _build_history_json(history, points, encoding))
+
+
+def _fetch_history():
+    history = []
+    for s in sensor_registry.get_all():
+        rrddef = s.get_rrd_definition()
+        if rrddb.is_rrd_initialized(rrddef):
+            history.append((s, history_cache.fetch(rrddef, 'AVERAGE', timedelta(days=365), use_real_start=True)))
+    return history
+
+
+def _build_history_json(history, points=None, encoding=None):
     types = SensorType.query.all()
 
     data = {'yAxes': [], 'series': []}
@@ -71,31 +189,91 @@ def process_history_json():
             'unit': t.unit
         })
 
-    for s in sensors:
-        rrddef = s.get_rrd_definition()
-        if rrddb.is_rrd_initialized(rrddef):
-            data['series'].append({
-                'name': s.description,
-                'yAxis': s.type.description,
-                'data': rrddb.fetch(rrddef, 'AVERAGE', timedelta(days=365), use_real_start=True).to_json_dict(
-                    only_data=True)
-            })
+    for s, results in history:
+        serie = {
+            'name': s.description,
+            'yAxis': s.type.description
+        }
+        if encoding == 'f32':
+            serie.update(results.to_binary_dict(points))
+        else:
+            serie['data'] = results.to_json_dict(only_data=True, drop_gaps=True, points=points)
+        data['series'].append(serie)
 
     return data
 
 
-def process_initialization_data():
+def process_sensor_history(sensor_id, from_ts=None, to_ts=None, cf=None, resolution=None):
+    """ Returns a generator of JSON chunks of the sensor series in the range ({"from", "step", "data", "to"},
+    unknown values are null), None if the sensor has no series. Defaults to the last day, the first of
+    RRDTOOL_DEFAULT_CFS and the resolution keeping the period, the range starts no earlier than the archive
+    keeps values. Raises ValueError for an invalid range.
+    """
+    sensor = sensor_registry.get_by_id(sensor_id)
+    if sensor is None:
+        return None
+    rrddef = sensor.get_rrd_definition()
+    if not rrddb.is_rrd_initialized(rrddef):
+        return None
+
+    if to_ts is None:
+        to_ts = du.timestamp(du.datetime_now())
+    if from_ts is None:
+        from_ts = to_ts - 24 * 60 * 60
+    if cf is None:
+        cf = current_app.config['RRDTOOL_DEFAULT_CFS'][0]
+    if cf not in current_app.config['RRDTOOL_DEFAULT_CFS'] or from_ts >= to_ts:
+        raise ValueError('Invalid range %s - %s or consolidation function %s' % (from_ts, to_ts, cf))
+    if resolution is None:
+        resolution = rrddb.get_resolution(rrddef, timedelta(seconds=to_ts - from_ts))
+    elif resolution <= 0:
+        raise ValueError('Invalid resolution %s' % (resolution,))
+
+    from_ts = rrddb.align_ts(from_ts, resolution)
+    to_ts = max(rrddb.align_ts(to_ts, resolution), from_ts + resolution)
+    # nothing is kept before, do not read the range row by row
+    from_ts = max(from_ts, min(rrddb.align_ts(rrddb.get_first_ts(rrddef, resolution), resolution),
+                               to_ts - resolution))
+    return _stream_series(rrddef, cf, resolution, from_ts, to_ts, current_app.config['HISTORY_CHUNK_ROWS'])
+
+
+def _stream_series(rrddef, cf, resolution, from_ts, to_ts, chunk_rows):
+    """ Fetches and serializes chunk_rows rows at a time, memory used does not depend on the range
+    """
+    next_ts = from_ts
+    step = None
+    while next_ts < to_ts:
+        results = rrddb.fetch_range(rrddef, cf, resolution, next_ts,
+                                    min(to_ts, next_ts + chunk_rows * (step or resolution)))
+        if step is None:
+            step = results.step
+            yield '{"from":%d,"step":%d,"data":[' % (results.from_ts, step)
+        else:
+            # rows of the previous chunk
+            results = results.since(next_ts)
+            if len(results.values) > 0:
+                yield ','
+
+        yield json.dumps(results.to_json_dict()['data'], separators=(',', ':'))[1:-1]
+
+        if results.to_ts <= next_ts:
+            break
+        next_ts = results.to_ts
+
+    yield '],"to":%d}' % (next_ts,)
+
+
+def process_initialization_data(encoding=None):
+    """ Sends initial data to the connected client, with encoding 'f32' histories are packed
+    (see live_cache.get_sensor_data)
+    """
     sensors = []
 
-    for s in Sensor.query.all():
+    for s in sensor_registry.get_all():
         d = to_json_dict(s)
-        rrddef = s.get_rrd_definition()
-        if rrddb.is_rrd_initialized(rrddef):
-            last = rrddb.fetch_last(rrddef)
-            d['read_ts'] = du.timestamp(last[0])
-            d['value'] = last[1]
-            d['history'] = rrddb.fetch(rrddef, 'AVERAGE', timedelta(days=1),
-                                       timedelta(minutes=5)).to_json_dict()
+        sensor_data = live_cache.get_sensor_data(s, encoding)
+        if sensor_data is not None:
+            d['read_ts'], d['value'], d['history'] = sensor_data
 
         sensors.append(d)
 
@@ -104,17 +282,17 @@ def process_initialization_data():
         Notification.created_ts.desc()).limit(6).all())
     contacts = to_json_dict(Contact.query.all())
     calls = callcenter.get_calls_in_progress()
-    socketio.emit('initial data', {
+    emit('initial data', {
         'sensors': sensors,
         'relays': relays,
         'notifications': notifications,
         'contacts': contacts,
         'calls': calls
-    }, namespace=socketio_namespace)
+    })
 
     # delayed initialization
-    for r in relays:
-        relay_controller.get_relay_state(r['id'], r['arduino_pin'], process_emit_relay_state)
+    relay_pins = [(r['id'], r['arduino_pin']) for r in relays if r['arduino_pin'] is not None]
+    relay_controller.get_all_relay_states(relay_pins, process_emit_relay_state)
 
 
 def process_relay_update_state(data):
@@ -209,6 +387,7 @@ def process_change_warning_values(data):
     sensor.observable_alarming_measurements = _cast_or_default(int, data['observable_alarming_measurements'])
     sensor.warning_wait_minutes = _cast_or_default(int, data['warning_wait_minutes'])
     db.session.commit()
+    sensor_registry.invalidate()
     d = sensor.to_json_dict(included_keys=['id', 'sensor_code',
                                            'min_warning_value', 'max_warning_value', 'enable_warnings',
                                            'observable_measurements', 'observable_alarming_measurements',
@@ -0,0 +1,77 @@
+"""
+    Coalesces 'sensor update' socket.io messages.
+
+    Updates are collected for SOCKETIO_SENSOR_UPDATE_WINDOW seconds and sent as one 'sensor updates'
+    message with only the latest update of every sensor.
+"""
+import threading
+from time import sleep
+
+from flask import current_app
+
+from .. import socketio, thread_monitor
+from . import socketio_namespace
+
+_lock = threading.Lock()
+_pending = {}
+_has_pending = threading.Event()
+_running = False
+
+_stats = {
+    'updates': 0,
+    'batches': 0,
+    'emitted': 0,
+    'last_batch_size': 0,
+    'max_batch_size': 0
+}
+
+
+def start():
+    global _running
+    _running = True
+    thread_monitor.start_thread('Sensor update batcher', restart_on_exit=True, target=_run)
+
+
+def get_stats():
+    with _lock:
+        return dict(_stats)
+
+
+def emit(sensor_update):
+    if not _running or current_app.config['SOCKETIO_SENSOR_UPDATE_WINDOW'] is None:
+        socketio.emit('sensor update', sensor_update, namespace=socketio_namespace)
+        return
+
+    with _lock:
+        _pending[sensor_update['sensor_id']] = sensor_update
+        _stats['updates'] += 1
+    _has_pending.set()
+
+
+def emit_now(sensor_update):
+    """ Sends the update immediately (alarms), a pending older update of the same sensor is dropped
+    """
+    with _lock:
+        _pending.pop(sensor_update['sensor_id'], None)
+        _stats['updates'] += 1
+    socketio.emit('sensor update', sensor_update, namespace=socketio_namespace)
+
+
+def _run():
+    global _pending
+    while True:
+        _has_pending.wait()
+        sleep(current_app.config['SOCKETIO_SENSOR_UPDATE_WINDOW'])
+
+        with _lock:
+            _has_pending.clear()
+            batch = _pending.values()
+            _pending = {}
+            if len(batch) > 0:
+                _stats['batches'] += 1
+                _stats['emitted'] += len(batch)
+                _stats['last_batch_size'] = len(batch)
+                _stats['max_batch_size'] = max(_stats['max_batch_size'], len(batch))
+
+        if len(batch) > 0:
+            socketio.emit('sensor updates', batch, namespace=socketio_namespace)
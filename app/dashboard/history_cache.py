@@ -0,0 +1,93 @@
+"""
+    Cache of long period RRD fetches (used for /history.json).
+
+    Series are kept per (path, cf, resolution) and aligned to the resolution, with all data sources of the
+    database (sensors sharing the database are fetched once). When a series is requested again, only the tail
+    since the last cached row is fetched from rrdtool and merged into the cached one.
+    The serialized (and compressed) response body is kept, per number of points the series are decimated to,
+    as long as none of its series changed.
+"""
+import gzip
+import hashlib
+from StringIO import StringIO
+from threading import Lock
+
+from flask import json
+
+from app import rrddb
+from .. import date_util
+
+_lock = Lock()
+_series = {}
+_real_start_ts = {}
+# points: CachedBody
+_bodies = {}
+
+
+class CachedBody(object):
+    def __init__(self, version, data):
+        self.version = version
+        self.data = data
+        self.etag = hashlib.md5(data).hexdigest()
+        self._gzip_data = None
+
+    @property
+    def gzip_data(self):
+        if self._gzip_data is None:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+                f.write(self.data)
+            self._gzip_data = buf.getvalue()
+        return self._gzip_data
+
+
+def fetch(rrddef, cf, period_td, use_real_start=False):
+    resolution = rrddb.get_resolution(rrddef, period_td)
+    to_ts = rrddb.align_ts(date_util.timestamp(date_util.datetime_now()), resolution)
+    key = (rrddef.path, cf, resolution)
+
+    with _lock:
+        from_ts = to_ts - int(period_td.total_seconds())
+        if use_real_start:
+            if rrddef.path not in _real_start_ts:
+                _real_start_ts[rrddef.path] = rrddb.get_real_start_ts(rrddef)
+            if _real_start_ts[rrddef.path] is not None:
+                from_ts = max(from_ts, _real_start_ts[rrddef.path])
+        from_ts = rrddb.align_ts(from_ts, resolution)
+
+        cached = _series.get(key)
+        if cached is not None and rrddef.name not in cached[1].names:
+            # data source added to the database since
+            cached = None
+        if cached is not None and cached[0] >= to_ts:
+            return cached[1].select([rrddef.name])
+
+        if cached is None or cached[0] - resolution <= from_ts:
+            results = rrddb.fetch_all_range(rrddef.path, cf, resolution, from_ts, to_ts)
+        else:
+            # the last cached row might not have been consolidated yet, fetch it again
+            tail = rrddb.fetch_all_range(rrddef.path, cf, resolution, cached[0] - resolution, to_ts)
+            if tail.names == cached[1].names:
+                results = cached[1].merge(tail).since(from_ts)
+            else:
+                results = rrddb.fetch_all_range(rrddef.path, cf, resolution, from_ts, to_ts)
+
+        _series[key] = (to_ts, results)
+        return results.select([rrddef.name])
+
+
+def get_body(points, version, build_data):
+    """ Returns the cached body for points and version or builds (and caches) a new one from build_data()
+    """
+    body = _bodies.get(points)
+    if body is None or body.version != version:
+        body = CachedBody(version, json.dumps(build_data(), separators=(',', ':')))
+        _bodies[points] = body
+    return body
+
+
+def clear():
+    with _lock:
+        _series.clear()
+        _real_start_ts.clear()
+        _bodies.clear()
@@ -19,9 +19,9 @@ def send_warnings(warnings, call_in_progress_callback, call_ended_callback):
         if c.phone and c.enable_sms_warnings:
             callcenter.send_sms(c.phone, notification.text)
         if c.email and c.enable_email_warnings:
+            # rendered later by the notification dispatcher, do not pass session bound objects
             email.send_email(c.email, notification.subject,
                              'mail/notification',
-                             notification=notification,
                              warnings=warnings)
 
         if c.phone and c.enable_phone_call_warnings \
@@ -0,0 +1,157 @@
+"""
+    Last values and a short history (24h in 5 minute buckets) of every sensor, kept in memory.
+
+    The measurement pipeline keeps the cache current, RRD databases are read only once per sensor (to seed
+    the cache after startup), so client initialization does not need any rrdtool calls.
+"""
+from array import array
+from datetime import timedelta
+from threading import Lock
+
+from app import rrddb
+from .. import date_util
+from ..models import encode_float32
+
+HISTORY_PERIOD = 24 * 60 * 60
+HISTORY_STEP = 5 * 60
+
+_lock = Lock()
+_sensors = {}
+
+
+class SensorCache(object):
+    def __init__(self, rrddef, period=HISTORY_PERIOD, step=HISTORY_STEP):
+        self.rrddef = rrddef
+        self.period = period
+        self.step = step
+        self.seeded = False
+        # held while reading the RRD database, the values are merged under the module lock
+        self.seed_lock = Lock()
+        self.last_ts = None
+        self.last_value = None
+
+        nr_buckets = period // step
+        self._bucket_ts = array('l', [-1]) * nr_buckets
+        self._sums = array('d', [0.0]) * nr_buckets
+        self._counts = array('l', [0]) * nr_buckets
+
+    def _bucket(self, ts):
+        bucket_ts = ts - ts % self.step
+        idx = (bucket_ts // self.step) % len(self._bucket_ts)
+        if self._bucket_ts[idx] != bucket_ts:
+            self._bucket_ts[idx] = bucket_ts
+            self._sums[idx] = 0.0
+            self._counts[idx] = 0
+        return idx
+
+    def record(self, ts, value):
+        if self.last_ts is None or ts >= self.last_ts:
+            self.last_ts = ts
+            self.last_value = value
+
+        idx = self._bucket(ts)
+        self._sums[idx] += value
+        self._counts[idx] += 1
+
+    def read_seed(self):
+        """ Reads the last value and the history from the RRD database, returns (last timestamp, last value,
+        [(timestamp, value)]) or None if the database is not initialized
+        """
+        if not rrddb.is_rrd_initialized(self.rrddef):
+            return None
+
+        last_dt, last_value = rrddb.fetch_last(self.rrddef)
+        history = rrddb.fetch(self.rrddef, 'AVERAGE', timedelta(seconds=self.period), timedelta(seconds=self.step))
+        return date_util.timestamp(last_dt), _to_float(last_value), zip(history.timestamps, history.values)
+
+    def seed(self, seed_data):
+        """ Fills the values not seen by the pipeline with seed_data (see read_seed)
+        """
+        self.seeded = True
+        if seed_data is None:
+            return
+
+        last_ts, last_value, history = seed_data
+        if self.last_ts is None:
+            self.last_ts = last_ts
+            self.last_value = last_value
+
+        for ts, value in history:
+            if value == value:
+                idx = self._bucket(int(ts))
+                if self._counts[idx] == 0:
+                    self._sums[idx] = value
+                    self._counts[idx] = 1
+
+    def history_json_dict(self, now_ts):
+        to_ts = now_ts - now_ts % self.step
+        from_ts = to_ts - self.period
+        data = []
+        for bucket_ts in xrange(from_ts, to_ts, self.step):
+            idx = (bucket_ts // self.step) % len(self._bucket_ts)
+            if self._bucket_ts[idx] == bucket_ts and self._counts[idx] > 0:
+                data.append(self._sums[idx] / self._counts[idx])
+            else:
+                data.append(None)
+
+        return {
+            'from': from_ts,
+            'to': to_ts,
+            'step': self.step,
+            'data': data
+        }
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get(sensor):
+    rrddef = sensor.get_rrd_definition()
+    cache = _sensors.get(sensor.id)
+    if cache is None or cache.rrddef.path != rrddef.path:
+        cache = _sensors[sensor.id] = SensorCache(rrddef)
+    return cache
+
+
+def record(sensor, read_ts, value):
+    with _lock:
+        _get(sensor).record(date_util.timestamp(read_ts), value)
+
+
+def get_sensor_data(sensor, encoding=None):
+    """ Returns (last read timestamp, last value, history json dict) or None if nothing is known, with
+    encoding 'f32' history values are packed ({'from', 'step', 'values'}, see models.encode_float32)
+    """
+    with _lock:
+        cache = _get(sensor)
+
+    if not cache.seeded:
+        # the database is read without blocking the pipeline, only once per sensor
+        with cache.seed_lock:
+            if not cache.seeded:
+                seed_data = cache.read_seed()
+                with _lock:
+                    cache.seed(seed_data)
+
+    with _lock:
+        if cache.last_ts is None:
+            return None
+        now_ts = date_util.timestamp(date_util.datetime_now())
+        last_ts, last_value, history = cache.last_ts, cache.last_value, cache.history_json_dict(now_ts)
+
+    if encoding == 'f32':
+        history = {
+            'from': history['from'],
+            'step': history['step'],
+            'values': encode_float32(history['data'])
+        }
+    return last_ts, last_value, history
+
+
+def clear():
+    with _lock:
+        _sensors.clear()
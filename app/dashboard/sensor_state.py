@@ -1,29 +1,169 @@
+from array import array
 from collections import deque
 
 from flask import current_app
 
-from ..models import StateWarning
+from ..models import StateWarning, Measurement
 from .. import date_util
 
 
+class AlarmWindow(object):
+    """ Sliding window over the last `size` (timestamp, value) samples, kept in array-backed ring buffers.
+
+    Counts of too low/too high values and the window minimum/maximum (monotonic deques) are kept up to date
+    on append and eviction, so the cost per sample does not depend on the window size.
+    """
+
+    def __init__(self, size, min_limit=None, max_limit=None):
+        self.size = size
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.nr_low = 0
+        self.nr_high = 0
+
+        self._capacity = 0
+        self._values = array('d')
+        self._timestamps = array('d')
+        # samples are numbered, sample with number seq is stored at index seq % capacity
+        self._first_seq = 0
+        self._next_seq = 0
+        self._mins = deque()
+        self._maxs = deque()
+
+        self._reserve(size)
+
+    def __len__(self):
+        return self._next_seq - self._first_seq
+
+    def _reserve(self, size):
+        capacity = max(1, (size or 0) + 1)
+        if capacity <= self._capacity:
+            return
+        values = array('d', [0.0]) * capacity
+        timestamps = array('d', [0.0]) * capacity
+        for seq in xrange(self._first_seq, self._next_seq):
+            values[seq % capacity] = self._values[seq % self._capacity]
+            timestamps[seq % capacity] = self._timestamps[seq % self._capacity]
+        self._values = values
+        self._timestamps = timestamps
+        self._capacity = capacity
+
+    def _value(self, seq):
+        return self._values[seq % self._capacity]
+
+    def is_full(self):
+        return self.size is None or len(self) >= self.size
+
+    def is_too_low(self, value):
+        return self.min_limit is not None and value < self.min_limit
+
+    def is_too_high(self, value):
+        return self.max_limit is not None and value > self.max_limit
+
+    def append(self, value, ts=0.0):
+        if len(self) == self._capacity:
+            # only for unbounded windows
+            self._reserve(self._capacity * 2)
+
+        seq = self._next_seq
+        self._next_seq += 1
+        self._values[seq % self._capacity] = value
+        self._timestamps[seq % self._capacity] = ts
+
+        if self.is_too_low(value):
+            self.nr_low += 1
+        if self.is_too_high(value):
+            self.nr_high += 1
+
+        while self._mins and self._value(self._mins[-1]) >= value:
+            self._mins.pop()
+        self._mins.append(seq)
+
+        while self._maxs and self._value(self._maxs[-1]) <= value:
+            self._maxs.pop()
+        self._maxs.append(seq)
+
+        self._evict_overflow()
+
+    def _evict_overflow(self):
+        while self.size is not None and len(self) > self.size:
+            seq = self._first_seq
+            value = self._value(seq)
+            self._first_seq += 1
+
+            if self.is_too_low(value):
+                self.nr_low -= 1
+            if self.is_too_high(value):
+                self.nr_high -= 1
+
+            if self._mins[0] == seq:
+                self._mins.popleft()
+            if self._maxs[0] == seq:
+                self._maxs.popleft()
+
+    def resize(self, size):
+        if size != self.size:
+            self.size = size
+            self._evict_overflow()
+            self._reserve(size)
+
+    def set_limits(self, min_limit, max_limit):
+        if min_limit == self.min_limit and max_limit == self.max_limit:
+            return
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        # limits changed, so counts need to be recalculated (only happens on settings change)
+        self.nr_low = sum(1 for ts, value in self.items() if self.is_too_low(value))
+        self.nr_high = sum(1 for ts, value in self.items() if self.is_too_high(value))
+
+    def min(self):
+        return self._value(self._mins[0]) if self._mins else None
+
+    def max(self):
+        return self._value(self._maxs[0]) if self._maxs else None
+
+    def items(self):
+        """ Returns (timestamp, value) pairs from the oldest on
+        """
+        return [(self._timestamps[seq % self._capacity], self._values[seq % self._capacity])
+                for seq in xrange(self._first_seq, self._next_seq)]
+
+    def too_low_items(self):
+        return [(ts, value) for ts, value in self.items() if self.is_too_low(value)]
+
+    def too_high_items(self):
+        return [(ts, value) for ts, value in self.items() if self.is_too_high(value)]
+
+    def clear(self):
+        self._first_seq = self._next_seq
+        self._mins.clear()
+        self._maxs.clear()
+        self.nr_low = 0
+        self.nr_high = 0
+
+
 class SensorState:
     def __init__(self, sensor):
         self.sensor = sensor
-        self.measurements = deque(maxlen=sensor.observable_measurements)
+        self.window = AlarmWindow(sensor.observable_measurements,
+                                  sensor.min_warning_value,
+                                  sensor.max_warning_value)
         self.last_notification = None
 
-    def update(self, measurement):
+    def update(self, sensor, measurement):
 
         # update sensor settings
-        if measurement.sensor is not None:
-            self.sensor = measurement.sensor
+        self.sensor = sensor
 
-        # update collection to current size
-        if len(self.measurements) != measurement.sensor.observable_measurements:
-            self.measurements = deque(self.measurements,
-                                      maxlen=self.sensor.observable_measurements)
+        # update window to current size and limits
+        self.window.resize(self.sensor.observable_measurements)
+        self.window.set_limits(self.sensor.min_warning_value, self.sensor.max_warning_value)
 
-        self.measurements.append(measurement)
+        self.window.append(measurement.value, date_util.timestamp(measurement.read_ts))
+
+    def _to_measurements(self, items):
+        return [Measurement(self.sensor.sensor_code, value, date_util.datetime_from_timestamp(ts))
+                for ts, value in items]
 
     def check_alarming_values(self):
         """ Returns alarming values if there are any, else return None
@@ -37,42 +177,38 @@ class SensorState:
 
         # Decide whether conditions are alarming and proceed
         # 1. Do we have enough measurements
-        if len(self.measurements) < self.measurements.maxlen:
+        if not self.window.is_full():
             return None
 
         # 2. Do we have enough alarming measurements
-        alarming_low = [m for m in self.measurements if
-                        self.sensor.is_value_too_low(m.value)]
-        alarming_high = [m for m in self.measurements if self.sensor.is_value_too_high(m.value)]
-        if (len(alarming_low) + len(alarming_high)) < self.sensor.observable_alarming_measurements:
+        nr_alarming = self.window.nr_low + self.window.nr_high
+        if nr_alarming == 0 or nr_alarming < self.sensor.observable_alarming_measurements:
             return None
 
         # State is alarming
-        # Which value is alarming
-        max_value = max(m.value for m in alarming_low + alarming_high)
-        min_value = min(m.value for m in alarming_low + alarming_high)
-
-        # clear measurements
-        self.measurements.clear()
-
         warnings = []
 
         # Is it too low or too high or both (if limits are wrongly set)
-        if self.sensor.is_value_too_low(min_value):
+        # If any value is too low, the window minimum is too low as well (same for maximum)
+        if self.window.nr_low > 0:
             warnings.append(StateWarning(limit=self.sensor.min_warning_value,
-                                         value=min_value,
+                                         value=self.window.min(),
                                          created_ts=now,
                                          sensor=self.sensor,
-                                         alarming_measurements=alarming_low))
+                                         alarming_measurements=self._to_measurements(self.window.too_low_items())))
             current_app.logger.info('Alarming values: too low %r' % (warnings[-1],))
 
-        if self.sensor.is_value_too_high(max_value):
+        if self.window.nr_high > 0:
             warnings.append(StateWarning(limit=self.sensor.max_warning_value,
-                                         value=max_value,
+                                         value=self.window.max(),
                                          created_ts=now,
                                          sensor=self.sensor,
-                                         alarming_measurements=alarming_high))
+                                         alarming_measurements=self._to_measurements(self.window.too_high_items())))
             current_app.logger.info('Alarming values: too high %r' % (warnings[-1],))
+
+        # clear measurements
+        self.window.clear()
+
         self.last_notification = now
         return warnings
 
@@ -80,10 +216,11 @@ class SensorState:
 CURRENT_SENSOR_STATES = {}
 
 
-def update_and_get_warnings(measurement):
-    current_state = CURRENT_SENSOR_STATES.setdefault(measurement.sensor.id,
-                                                     SensorState(measurement.sensor))
+def update_and_get_warnings(sensor, measurement):
+    current_state = CURRENT_SENSOR_STATES.get(sensor.id)
+    if current_state is None:
+        current_state = CURRENT_SENSOR_STATES[sensor.id] = SensorState(sensor)
 
-    current_state.update(measurement)
+    current_state.update(sensor, measurement)
 
     return current_state.check_alarming_values()
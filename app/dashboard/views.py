@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 # TODO: Auth for socket.io
 
-from flask import render_template, current_app, jsonify, request
+from flask import render_template, current_app, request, jsonify, abort, stream_with_context
 from flask.ext.login import login_required
+from werkzeug.security import safe_str_cmp
 from os import getpid
 
 from . import dashboard, socketio_namespace
@@ -17,6 +18,18 @@ def start_routines():
     controller.init()
 
 
+def stop_routines():
+    current_app.logger.info('Flushing pending data')
+    controller.shutdown()
+
+
+def _series_encoding():
+    """ 'f32' if the client asked for packed series (encoding argument or the series_encoding cookie set at login)
+    """
+    encoding = request.args.get('encoding') or request.cookies.get('series_encoding')
+    return encoding if encoding == 'f32' else None
+
+
 @dashboard.route('/')
 @dashboard.route('/index.html')
 @login_required
@@ -34,14 +47,62 @@ def charts():
 @dashboard.route('/history.json')
 @login_required
 def history():
-    data = controller.process_history_json()
-    return jsonify(data)
+    # points: width of the chart, series are decimated to it
+    body = controller.process_history_body(request.args.get('points', type=int), _series_encoding())
+
+    if request.if_none_match.contains(body.etag):
+        response = current_app.response_class(status=304)
+    elif request.accept_encodings['gzip']:
+        response = current_app.response_class(body.gzip_data, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = current_app.response_class(body.data, mimetype='application/json')
+
+    response.set_etag(body.etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@dashboard.route('/sensors/<int:sensor_id>/history.json')
+@login_required
+def sensor_history(sensor_id):
+    # from, to: seconds since epoch, cf: consolidation function, resolution: seconds
+    try:
+        chunks = controller.process_sensor_history(sensor_id, request.args.get('from', type=int),
+                                                   request.args.get('to', type=int), request.args.get('cf'),
+                                                   request.args.get('resolution', type=int))
+    except ValueError:
+        abort(400)
+    if chunks is None:
+        abort(404)
+
+    # streamed (chunked transfer encoding), never built in memory
+    return current_app.response_class(stream_with_context(chunks), mimetype='application/json')
+
+
+@dashboard.route('/threads.json')
+@login_required
+def threads():
+    return jsonify({'threads': thread_monitor.snapshot()})
+
+
+@dashboard.route('/metrics')
+def metrics():
+    # scraped by Prometheus with the METRICS_TOKEN bearer token, else login is required
+    token = current_app.config['METRICS_TOKEN']
+    if token and safe_str_cmp(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        return _render_metrics()
+    return login_required(_render_metrics)()
+
+
+def _render_metrics():
+    return current_app.response_class(controller.process_metrics(), mimetype='text/plain; version=0.0.4')
 
 
 @socketio.on('connect', namespace=socketio_namespace)
 def test_connect():
     current_app.logger.info('Client connected')
-    controller.process_initialization_data()
+    controller.process_initialization_data(_series_encoding())
 
 
 @socketio.on('sensor update warning values', namespace=socketio_namespace)
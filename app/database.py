@@ -0,0 +1,46 @@
+"""
+    SQLite setup of the dashboard database, which is used from many threads at once (serial listener, relay
+    callbacks, socket.io handlers, notifications).
+
+    Connections are switched to WAL journal, so readers do not wait for a writer and the other way round, and
+    are tuned with SQLITE_PRAGMAS. Instead of opening a new connection for every session (NullPool, default
+    for SQLite files) connections are kept open in a pool and every thread keeps using the same one.
+"""
+from flask.ext.sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+class SQLitePool(QueuePool):
+    pass
+
+
+def _pool_class(pragmas):
+    """ SQLitePool subclass setting the (name, value) pragmas on every new connection, works without an
+    application context
+    """
+    class Pool(SQLitePool):
+        pass
+
+    @event.listens_for(Pool, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s=%s' % (name, value))
+        cursor.close()
+
+    return Pool
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite' and info.database not in (None, '', ':memory:') \
+                and app.config['SQLITE_POOL_SIZE']:
+            options['poolclass'] = _pool_class(list(app.config['SQLITE_PRAGMAS']))
+            options['pool_size'] = app.config['SQLITE_POOL_SIZE']
+            options.setdefault('max_overflow', app.config['SQLITE_POOL_MAX_OVERFLOW'])
+            # thread gets back its own connection while it holds it
+            options['pool_threadlocal'] = True
+            # pooled connections are used by different threads one after another
+            options['connect_args'] = {'check_same_thread': False}
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
@@ -1,15 +1,39 @@
+from collections import namedtuple
+
 from flask import current_app, render_template
 from flask.ext.mail import Message
 
-from . import mail, thread_monitor
+from . import mail, notification_dispatcher
+
+EmailMessage = namedtuple('EmailMessage', 'to subject template context')
 
 
 def send_email(to, subject, template, **kwargs):
-    log_message = 'Sending e-mail to %s (%s)' % (to, subject)
-    current_app.logger.info(log_message)
-    msg = Message(current_app.config['APP_EMAIL_SUBJECT_PREFIX'] + ' ' + subject,
-                  recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
+    """ Queues the e-mail, template is rendered by the notification dispatcher
+    """
+    current_app.logger.info('Sending e-mail to %s (%s)' % (to, subject))
+    notification_dispatcher.submit('email', EmailMessage(to, subject, template, kwargs))
+
+
+def create_message(email_message):
+    msg = Message(current_app.config['APP_EMAIL_SUBJECT_PREFIX'] + ' ' + email_message.subject,
+                  recipients=[email_message.to])
+    msg.body = render_template(email_message.template + '.txt', **email_message.context)
+    return msg
+
+
+def _send_emails(email_messages):
+    failed = []
+    # one SMTP connection for the whole batch
+    with mail.connect() as connection:
+        for m in email_messages:
+            try:
+                connection.send(create_message(m))
+            except Exception as e:
+                current_app.logger.info('Sending e-mail to %s failed' % (m.to,))
+                current_app.logger.exception(e)
+                failed.append(m)
+    return failed
 
-    thread_monitor.start_thread(log_message, False, mail.send, (msg,))
 
+notification_dispatcher.register('email', _send_emails)
@@ -1,15 +1,18 @@
-from threading import Lock
+from threading import Lock, Event
+from collections import deque
+import Queue
 import random
-from time import sleep
+from time import sleep, time
 
 import serial
 from flask import current_app
 
 from ..models import RelayState
-from .. import thread_monitor
+from .. import thread_monitor, metrics
 
 
 switch_lock = Lock()
+query_latency = metrics.histogram('farmcontrol_relay_query_seconds', 'Relay board query round trip time')
 
 
 class InvalidSerialResponseException(Exception):
@@ -17,10 +20,9 @@ class InvalidSerialResponseException(Exception):
 
 
 def switch(relay, next_relay_state, callback):
-    thread_monitor.start_thread('Relay switch',
-                                restart_on_exit=False,
-                                target=perform_switch,
-                                args=(relay.id, relay.arduino_pin, next_relay_state, callback))
+    thread_monitor.submit('relay', 'Relay switch %d' % (relay.id,),
+                          target=perform_switch,
+                          args=(relay.id, relay.arduino_pin, next_relay_state, callback))
 
 
 def perform_switch(relay_id, arduino_pin, next_relay_state, callback):
@@ -35,57 +37,265 @@ def perform_switch(relay_id, arduino_pin, next_relay_state, callback):
         current_app.logger.exception(e)
         response = RelayState(arduino_pin, RelayState.Error)
 
+    _update_cached_relay_state(response)
     callback(relay_id, response)
 
 
 def get_relay_state(relay_id, arduino_pin, callback, onerror=None):
-    thread_monitor.start_thread('Get relay state %d' % (relay_id,),
-                                restart_on_exit=False,
-                                target=perform_get_relay_state,
-                                args=(relay_id, arduino_pin, callback),
-                                onerror=onerror)
+    thread_monitor.submit('relay', 'Get relay state %d' % (relay_id,),
+                          target=perform_get_relay_state,
+                          args=(relay_id, arduino_pin, callback),
+                          onerror=onerror)
 
 
 def perform_get_relay_state(relay_id, arduino_pin, callback):
     query = create_query(arduino_pin, 'STATE')
     response = perform_query(query)
+    _update_cached_relay_state(response)
     callback(relay_id, response)
 
 
-def perform_query(query, max_repeat=5):
-    if not current_app.config['RELAY_BOARD']:
-        return perform_dummy_query(query)
-    repeat = False
-    response = None
-    with switch_lock:
-        with serial.Serial(port=current_app.config['RELAY_BOARD_PORT'],
-                           baudrate=current_app.config['RELAY_BOARD_BAUD'],
-                           timeout=2, writeTimeout=2) as ser:
+def get_all_relay_states(relays, callback, onerror=None):
+    """ relays is a list of (relay_id, arduino_pin), callback is called for every relay
+    """
+    thread_monitor.submit('relay', 'Get all relay states',
+                          target=perform_get_all_relay_states,
+                          args=(relays, callback),
+                          onerror=onerror)
+
+
+def perform_get_all_relay_states(relays, callback):
+    states = fetch_all_relay_states([pin for relay_id, pin in relays])
+    for relay_id, pin in relays:
+        callback(relay_id, states.get(pin, RelayState(pin, RelayState.Error)))
+
+
+states_lock = Lock()
+cached_states = {}
+cached_states_ts = None
+
 
+def fetch_all_relay_states(pins):
+    """ Returns {pin: RelayState} for all pins queried in one exchange. Results are cached for
+    RELAY_STATE_CACHE_SECONDS (callers run one at a time in the 'relay' pool).
+    """
+    global cached_states, cached_states_ts
+    pins = frozenset(pins)
+    with states_lock:
+        if cached_states_ts is not None \
+                and time() - cached_states_ts < current_app.config['RELAY_STATE_CACHE_SECONDS'] \
+                and pins.issubset(cached_states):
+            return dict(cached_states)
+
+    states = _query_relay_states(sorted(pins))
+    with states_lock:
+        cached_states = dict((pin, s) for pin, s in states.iteritems() if s.state != RelayState.Error)
+        cached_states_ts = time()
+    return states
+
+
+def _query_relay_states(pins):
+    queries = [create_query(pin, 'STATE') for pin in pins]
+    if not current_app.config['RELAY_BOARD']:
+        return perform_dummy_queries(queries)
+
+    responses = perform_queries(queries, raise_errors=False)
+    return dict((r.pin, r) for r in responses)
+
+
+def _update_cached_relay_state(relay_state):
+    with states_lock:
+        if relay_state.state == RelayState.Error:
+            cached_states.pop(relay_state.pin, None)
+        else:
+            cached_states[relay_state.pin] = relay_state
+
+
+class RelayCommand(object):
+    def __init__(self, query, max_repeat):
+        self.query = query
+        self.pin = get_query_pin(query)
+        self.max_repeat = max_repeat
+        self.response = None
+        self.error = None
+        # the caller gave up waiting, the query must not be written to the board any more
+        self.cancelled = False
+        self.done = Event()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def finish(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.done.set()
+
+    def repeat(self):
+        """ Returns False if repeat limit is reached, else changes the command to a state query
+        """
+        if self.max_repeat in (0, None):
+            return False
+        self.max_repeat -= 1
+        self.query = self.query[:self.query.find('_') + 1] + '2-'
+        return True
+
+
+class RelayBoardConnection(object):
+    """ Long-lived serial connection to the relay board, used only by the 'Relay board' thread
+    """
+
+    def __init__(self, port, baudrate):
+        self.port = port
+        self.baudrate = baudrate
+        self.ser = None
+
+    def open(self):
+        if self.ser is None:
+            current_app.logger.info('Opening relay board serial port %s:%s', self.port, self.baudrate)
+            self.ser = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=2, writeTimeout=2)
             sleep(.20)
+        return self.ser
 
-            ser.flushInput()
-            # Call for action
-            current_app.logger.debug('Performing relay query %s', query)
-            ser.write(query)
-            sleep(.30)
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except Exception as e:
+                current_app.logger.exception(e)
+            self.ser = None
+
+    def execute(self, commands):
+        """ Writes all queries at once and matches the responses to commands by pin.
+        Returns commands that should be repeated.
+        """
+        commands = [c for c in commands if not c.cancelled]
+        if len(commands) == 0:
+            return []
+
+        ser = self.open()
+        ser.flushInput()
+
+        pending = dict((c.pin, c) for c in commands)
+        current_app.logger.debug('Performing relay queries %s', [c.query for c in commands])
+        ser.write(''.join(c.query for c in commands))
+
+        while len(pending) > 0:
             response_str = ser.readline()
-
+            if response_str == '':
+                # timeout
+                break
             try:
                 response = parse_relay_state_response(response_str)
-                current_app.logger.debug('Result of query %s = %s' % (query, response_str))
-            except InvalidSerialResponseException as e:
-                current_app.logger.info('Could not parse response %s, repeat times %s' % (response_str, max_repeat))
-                if max_repeat in (0, None):
-                    raise e
-                else:
-                    repeat = True
-                    max_repeat -= 1
-                    sleep(.3)
-
-    if repeat is True:
-        return perform_query(query[:query.find('_') + 1] + '2-', max_repeat)
-    return response
+            except InvalidSerialResponseException:
+                current_app.logger.info('Could not parse response %s' % (response_str,))
+                continue
+
+            command = pending.pop(response.pin, None)
+            if command is not None:
+                current_app.logger.debug('Result of query %s = %s' % (command.query, response_str))
+                command.finish(response)
+
+        repeat = []
+        for command in pending.values():
+            current_app.logger.info('No valid response for %s, repeat times %s' % (command.query, command.max_repeat))
+            if not command.cancelled and command.repeat():
+                repeat.append(command)
+            else:
+                command.finish(error=InvalidSerialResponseException('No valid response for %s' % (command.query,)))
+        return repeat
+
+
+relay_commands = Queue.Queue()
+_board_lock = Lock()
+_board_started = False
+
+
+def _start_board():
+    global _board_started
+    with _board_lock:
+        if not _board_started:
+            thread_monitor.start_thread('Relay board', restart_on_exit=True, target=_board_loop)
+            _board_started = True
+
+
+def _next_batch(backlog):
+    """ Returns waiting commands (at most one per pin, so responses can be matched)
+    """
+    if len(backlog) == 0:
+        backlog.append(relay_commands.get())
+    while True:
+        try:
+            backlog.append(relay_commands.get_nowait())
+        except Queue.Empty:
+            break
+
+    batch, pins, rest = [], set(), deque()
+    for command in backlog:
+        if command.cancelled:
+            continue
+        if command.pin in pins:
+            rest.append(command)
+        else:
+            pins.add(command.pin)
+            batch.append(command)
+    backlog.clear()
+    backlog.extend(rest)
+    return batch
+
+
+def _board_loop():
+    connection = RelayBoardConnection(current_app.config['RELAY_BOARD_PORT'], current_app.config['RELAY_BOARD_BAUD'])
+    backlog = deque()
+    try:
+        while True:
+            batch = _next_batch(backlog)
+            try:
+                backlog.extend(connection.execute(batch))
+            except Exception as e:
+                # reconnect with next batch
+                current_app.logger.exception(e)
+                connection.close()
+                [c.finish(error=e) for c in batch if not c.done.is_set()]
+                sleep(.3)
+    finally:
+        connection.close()
+
+
+def perform_query(query, max_repeat=5):
+    started = time()
+    try:
+        if not current_app.config['RELAY_BOARD']:
+            return perform_dummy_query(query)
+        return perform_queries([query], max_repeat)[0]
+    finally:
+        query_latency.observe(time() - started)
+
+
+def perform_queries(queries, max_repeat=5, raise_errors=True):
+    """ Queries are sent to the relay board together (one round trip), returns responses in the same order.
+    Without raise_errors failed queries return RelayState.Error.
+    """
+    _start_board()
+    commands = [RelayCommand(query, max_repeat) for query in queries]
+    [relay_commands.put(c) for c in commands]
+
+    # one deadline for the whole batch
+    deadline = time() + current_app.config['RELAY_BOARD_QUERY_TIMEOUT']
+    responses = []
+    for c in commands:
+        c.done.wait(max(0, deadline - time()))
+        error = c.error
+        if not c.done.is_set():
+            c.cancel()
+            error = InvalidSerialResponseException('Relay query %s timed out' % (c.query,))
+        if error is None:
+            responses.append(c.response)
+        elif raise_errors:
+            raise error
+        else:
+            current_app.logger.info('Relay query %s failed: %s' % (c.query, error))
+            responses.append(RelayState(c.pin, RelayState.Error))
+    return responses
 
 
 def perform_dummy_query(query):
@@ -109,6 +319,29 @@ def perform_dummy_query(query):
     return response
 
 
+def perform_dummy_queries(queries):
+    with switch_lock:
+        sleep(0.5)
+
+        current_app.logger.log(8, 'Performing relay DUMMY queries %s', queries)
+        dummy_response = '\r\n'.join('{}_{}'.format(get_query_pin(query), random.choice(['ON', 'OF']))
+                                       for query in queries)
+        response = parse_relay_states_response(dummy_response)
+    return response
+
+
+def parse_relay_states_response(response_str):
+    """ Parses responses for many pins (one per line), returns {pin: RelayState}
+    """
+    states = {}
+    for line in response_str.splitlines():
+        if line.strip(' \t\r\n') == '':
+            continue
+        state = parse_relay_state_response(line)
+        states[state.pin] = state
+    return states
+
+
 def parse_relay_state_response(response_str):
     response_str = response_str.strip(' \t\r\n')
     response = response_str.split('_')
@@ -127,6 +360,10 @@ def parse_relay_state_response(response_str):
     return RelayState(pin, state)
 
 
+def get_query_pin(query):
+    return int(query[1:query.find('_')])
+
+
 def create_query(arduino_pin, query):
     if arduino_pin is None:
         raise Exception('Arduino pin for relay is not defined')
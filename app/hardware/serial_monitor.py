@@ -1,4 +1,9 @@
-from time import sleep
+from array import array
+from collections import namedtuple
+from datetime import datetime
+from itertools import izip
+from threading import Lock
+from time import sleep, time
 
 import serial
 from flask import current_app
@@ -13,45 +18,160 @@ def start(callback):
     thread_monitor.start_thread(name='Serial watch', restart_on_exit=True, target=target, args=(callback,))
 
 
+LLAP_FRAME_LENGTH = 12
+
+_stats_lock = Lock()
+_stats = {
+    'frames': 0,
+    'errors': 0,
+    'skipped_bytes': 0,
+    'frames_per_second': 0.0
+}
+_rate_window = {'start': time(), 'frames': 0}
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _update_stats(frames, errors, skipped_bytes):
+    with _stats_lock:
+        _stats['frames'] += frames
+        _stats['errors'] += errors
+        _stats['skipped_bytes'] += skipped_bytes
+
+        _rate_window['frames'] += frames
+        elapsed = time() - _rate_window['start']
+        if elapsed >= 10:
+            _stats['frames_per_second'] = _rate_window['frames'] / elapsed
+            _rate_window['start'] = time()
+            _rate_window['frames'] = 0
+
+
+def parse_llap_message(llap_msg):
+    """
+    Structure of expected LLAP message:
+    Max length 11 bytes
+    Example message: aZGB150.1---
+    0 - a - start of the message
+    1,2 - XX - device id (ZA/SA/...)
+    3 - H/T/B.. - sensor is (humidity/temperature)
+    4-11  -  Value (max 8 chars, trailed in the end with '-' (if number string is shorter))
+    When battery level meter is disabled LLAP looks like: ZGBc0------
+
+    llap_msg is the message without the starting 'a', returns None if the value can not be parsed
+    """
+    try:
+        # Remove trailing
+        val = float(llap_msg[3:].rstrip('-'))
+    except ValueError as e:
+        current_app.logger.log(7, 'Error parsing number from LLAP %s', llap_msg)
+        return None
+
+    return Measurement(llap_msg[:3], val, date_util.datetime_now())
+
+
 def get_sensor_value(stream):
     char = stream.read(1)
     measurement = None
     if char == 'a':
+        measurement = parse_llap_message(stream.read(11))
+
+    return measurement
 
-        """
-        Structure of expected LLAP message:
-        Max length 11 bytes
-        Example message: aZGB150.1---
-        0 - a - start of the message
-        1,2 - XX - device id (ZA/SA/...)
-        3 - H/T/B.. - sensor is (humidity/temperature)
-        4-11  -  Value (max 8 chars, trailed in the end with '-' (if number string is shorter))
-        When battery level meter is disabled LLAP looks like: ZGBc0------
-        """
 
-        llap_msg = stream.read(11)
+LLAPFrames = namedtuple('LLAPFrames', 'sensor_codes values timestamps consumed errors skipped_bytes')
 
-        measurement = Measurement(llap_msg[:3])
 
-        val = None
+def decode_llap_frames(buf, offset=0, read_ts=None):
+    """ Decodes all complete LLAP frames in buf (bytearray or str) from offset on, without copying the buffer.
+
+    Returns LLAPFrames: lists/arrays of sensor codes, values and read timestamps (seconds since epoch) of
+    valid frames, offset of the first byte not consumed (an incomplete frame at the end is not consumed),
+    number of invalid frames and number of skipped bytes. Invalid frames are skipped by one byte only, so
+    decoding resyncs on the next frame start.
+    """
+    if isinstance(buf, memoryview):
+        # memoryview can not be searched
+        buf = buf.tobytes()
+    if read_ts is None:
+        read_ts = time()
+
+    sensor_codes = []
+    values = array('d')
+    errors = 0
+    skipped = 0
+
+    length = len(buf)
+    pos = offset
+    while True:
+        start = buf.find('a', pos)
+        if start < 0:
+            skipped += length - pos
+            pos = length
+            break
+        skipped += start - pos
+        if length - start < LLAP_FRAME_LENGTH:
+            # wait for the rest of the frame
+            pos = start
+            break
+
+        # value is trailed with '-' (if number string is shorter), first char can be a minus sign
+        value_start = start + 4
+        value_end = buf.find('-', value_start + 1, start + LLAP_FRAME_LENGTH)
+        if value_end < 0:
+            value_end = start + LLAP_FRAME_LENGTH
         try:
-            # Remove trailing
-            val = float(llap_msg[3:].rstrip('-'))
-        except ValueError as e:
-            current_app.logger.log(7, 'Error parsing number from LLAP %s', llap_msg)
+            value = float(bytes(buf[value_start:value_end]))
+        except ValueError:
+            errors += 1
+            pos = start + 1
+            continue
 
-        if val is None:
-            measurement = None
-        else:
-            measurement.value = val
-            measurement.read_ts = date_util.datetime_now()
+        sensor_codes.append(bytes(buf[start + 1:value_start]))
+        values.append(value)
+        pos = start + LLAP_FRAME_LENGTH
 
-    return measurement
+    timestamps = array('d', [read_ts]) * len(values)
+    return LLAPFrames(sensor_codes, values, timestamps, pos, errors, skipped)
+
+
+def to_measurements(frames):
+    read_ts = None
+    read_dt = None
+    measurements = []
+    for sensor_code, value, ts in izip(frames.sensor_codes, frames.values, frames.timestamps):
+        # frames decoded together share the timestamp
+        if ts != read_ts:
+            read_ts = ts
+            read_dt = datetime.fromtimestamp(ts)
+        measurements.append(Measurement(sensor_code, value, read_dt))
+    return measurements
+
+
+class LLAPStreamParser(object):
+    """ Extracts LLAP frames from chunks of received bytes (see decode_llap_frames)
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        frames = decode_llap_frames(self.buffer)
+        del self.buffer[:frames.consumed]
+
+        if frames.errors > 0:
+            current_app.logger.log(7, 'Skipped %d invalid LLAP frames', frames.errors)
+        _update_stats(len(frames.values), frames.errors, frames.skipped_bytes)
+        return to_measurements(frames)
 
 
 def listen_real(callback):
     with serial.Serial(port=current_app.config['RADIO_LISTEN_ON_PORT'],
-                       baudrate=current_app.config['RADIO_LISTEN_ON_BAUD']) as ser:
+                       baudrate=current_app.config['RADIO_LISTEN_ON_BAUD'],
+                       timeout=current_app.config['RADIO_LISTEN_WAIT_SECONDS']) as ser:
 
         current_app.logger.info('Opening Slice of Pi serial port %s:%s',
                                 current_app.config['RADIO_LISTEN_ON_PORT'],
@@ -64,23 +184,20 @@ def listen_real(callback):
         # no old messages lying around
         ser.flushInput()
 
+        parser = LLAPStreamParser()
         while True:
-            current_app.logger.debug('Start read loop')
-
-            while ser.inWaiting():
-                measurement = get_sensor_value(ser)
-                if measurement is not None:
+            # blocks until the first byte arrives (or timeout), then takes everything that is waiting
+            data = ser.read(1)
+            if data:
+                data += ser.read(ser.inWaiting())
+                for measurement in parser.feed(data):
                     callback(measurement)
 
-            current_app.logger.debug('Finish read loop')
-            sleep(current_app.config['RADIO_LISTEN_WAIT_SECONDS'])
-
 
 """
     Only use for dev enviroment, generates random values or values put to DUMMY_VALUES
 """
 import random
-from io import StringIO
 from .. import models
 
 DUMMY_VALUES = {}
@@ -106,9 +223,8 @@ def listen_dummy_sensor(callback, min_possible_value, max_possible_value, sensor
     while True:
         # get a dummy value or generate a random one
         val = DUMMY_VALUES.get(sensor_code, round(random.uniform(min_possible_value, max_possible_value), 2))
-        llap_str = u'a{}{:.2f}'.format(sensor_code, val)
-        llap_str += '-' * (12 - len(llap_str))
-        llap_stream = StringIO(llap_str)
-        m = get_sensor_value(llap_stream)
-        callback(m)
+        llap_str = 'a{}{:.2f}'.format(sensor_code, val)
+        llap_str += '-' * (LLAP_FRAME_LENGTH - len(llap_str))
+        for m in to_measurements(decode_llap_frames(llap_str)):
+            callback(m)
         sleep(emit_every)
\ No newline at end of file
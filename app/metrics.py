@@ -0,0 +1,95 @@
+"""
+    Fixed bucket histograms for timing hot paths, rendered in Prometheus text format (dashboard /metrics).
+
+    Histograms are created once at import time, observe() only increments preallocated counters.
+"""
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+# seconds, from 50us (in-memory stages) to 10s (relay board round trips)
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+_histograms = []
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets))
+        # last counter is for values above the highest bucket (+Inf)
+        self.counts = array('l', [0]) * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """ Returns (cumulative counts per bucket including +Inf, sum, count)
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+
+        cumulative = []
+        running = 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+def histogram(name, help, labels=None, buckets=DEFAULT_BUCKETS):
+    h = Histogram(name, help, labels, buckets)
+    _histograms.append(h)
+    return h
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in sorted(labels.items()))
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+def render(gauges=()):
+    """ Returns all histograms and given gauges in Prometheus text format.
+
+    gauges is a list of (name, help, type, value, labels), samples of the same name must be adjacent
+    """
+    lines = []
+    described = set()
+
+    def describe(name, help, metric_type):
+        if name not in described:
+            described.add(name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+    for h in _histograms:
+        describe(h.name, h.help, 'histogram')
+        cumulative, total, count = h.snapshot()
+        for bound, c in zip(h.buckets + (float('inf'),), cumulative):
+            labels = dict(h.labels, le='+Inf' if bound == float('inf') else _format_value(bound))
+            lines.append('%s_bucket%s %d' % (h.name, _format_labels(labels), c))
+        lines.append('%s_sum%s %s' % (h.name, _format_labels(h.labels), _format_value(total)))
+        lines.append('%s_count%s %d' % (h.name, _format_labels(h.labels), count))
+
+    for name, help, metric_type, value, labels in gauges:
+        describe(name, help, metric_type)
+        lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+
+    return '\n'.join(lines) + '\n'
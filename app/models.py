@@ -1,5 +1,14 @@
+from array import array
+import base64
 from collections import namedtuple
+from itertools import izip
 from os import access, path, W_OK
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from flask import current_app
 from recordtype import recordtype
@@ -15,22 +24,13 @@ StateWarning = namedtuple('StateWarning', ['limit', 'value', 'created_ts', 'sens
 
 RRDDef = recordtype('RRDDef', 'name step path mmin mmax')
 
+NAN = float('nan')
 
-class Measurement(object):
-    def __init__(self, sensor_code):
-        self.sensor_code = sensor_code
-        self.sensor = None
-
-        self.value = None
-        self.read_ts = None
-        self.has_warning = False
-        self.has_notification = False
-
-    def init_sensor(self):
-        self.sensor = db.session.query(Sensor).filter(Sensor.sensor_code == self.sensor_code).first()
 
-    def init_has_warning(self):
-        self.has_warning = self.sensor.is_value_out_of_bounds(self.value)
+class Measurement(namedtuple('Measurement', 'sensor_code value read_ts')):
+    """ Immutable sample record, sensor settings are looked up by sensor_code (see sensor_registry)
+    """
+    __slots__ = ()
 
     def local_read_ts_str(self):
         return date_util.to_local_datetime(self.read_ts).strftime(current_app.config['DATETIME_FORMAT_W_TZ'])
@@ -46,14 +46,14 @@ class Measurement(object):
     def __repr__(self):
         return '<Measurement {}: {} [{}]>'.format(self.sensor_code, self.value, self.read_ts)
 
-    def to_json_dict(self):
+    def to_json_dict(self, sensor, has_notification=False):
         return mj.encode_dict({
-            'sensor_id': self.sensor.id,
+            'sensor_id': sensor.id,
             'sensor_code': self.sensor_code,
             'value': self.value,
             'read_ts': self.read_ts,
-            'has_warning': self.has_warning,
-            'has_notification': self.has_notification
+            'has_warning': sensor.is_value_out_of_bounds(self.value),
+            'has_notification': has_notification
         })
 
 
@@ -97,6 +97,10 @@ class Sensor(db.Model, mj.ModelJSONAPIMixin):
 
     @staticmethod
     def get_rrd_db_path(sensor_code, step):
+        if current_app.config['RRDTOOL_GROUP_SENSORS']:
+            # one database for all sensors with the same step
+            return path.join(current_app.config['DATABASE_DIR'],
+                             current_app.config['RRDTOOL_GROUP_NAME_TEMPLATE'] % (step,))
         return path.join(current_app.config['DATABASE_DIR'],
                          current_app.config['RRDTOOL_DATABASE_NAME_TEMPLATE'] % (
                              sensor_code, step))
@@ -262,13 +266,13 @@ class Notification(db.Model, mj.ModelJSONAPIMixin):
         })
 
 
-class RelayState(object):
+class RelayState(namedtuple('RelayState', 'pin state changed_ts')):
+    __slots__ = ()
     Off, PendingOff, On, PendingOn, Error = range(5)
 
-    def __init__(self, pin, state, changed_ts=None):
-        self.state = state
-        self.pin = pin
-        self.changed_ts = date_util.datetime_now() if changed_ts is None else changed_ts
+    def __new__(cls, pin, state, changed_ts=None):
+        return super(RelayState, cls).__new__(cls, pin, state,
+                                              date_util.datetime_now() if changed_ts is None else changed_ts)
 
     def __repr__(self):
         return '<RelayState %d %s>' % (self.pin, ['Off', 'PendingOff', 'On', 'PendingOn', 'Error'][self.state])
@@ -312,50 +316,277 @@ class RelayLog(db.Model, mj.ModelJSONAPIMixin):
         return '<RelayLog [%s] %s -> %s>' % (self.id, self.from_state, self.to_state)
 
 
+class OutboundMessage(db.Model):
+    """ Notification (e-mail, SMS) waiting in the queue of the notification dispatcher
+    """
+    __tablename__ = 'outbound_message'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16))
+    message = db.Column(db.PickleType)
+    created_ts = db.Column(db.DateTime)
+    nr_attempts = db.Column(db.Integer, default=0)
+    next_attempt_ts = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        return '<OutboundMessage [%s] %s, attempts: %s>' % (self.id, self.kind, self.nr_attempts)
+
+
 class RrdFetchResults(object):
+    """ Columnar view of rrdtool.fetch results: one float64 column per data source (NaN marks unknown values),
+    row i is timed at from_ts + i * step.
+    """
+
     def __init__(self, raw_data):
-        self.raw_data = raw_data
+        (from_ts, to_ts, step), names, rows = raw_data
+        self.from_ts = int(from_ts)
+        self.to_ts = int(to_ts)
+        self.step = int(step)
+        self.names = tuple(names)
+        self.columns = _to_columns(rows, len(self.names))
+
+    @classmethod
+    def from_columns(cls, names, from_ts, step, columns):
+        results = cls.__new__(cls)
+        results.from_ts = int(from_ts)
+        results.step = int(step)
+        results.to_ts = results.from_ts + results.step * len(columns[0])
+        results.names = tuple(names)
+        results.columns = columns
+        return results
+
+    def merge(self, tail):
+        """ Returns results with rows of tail replacing (or following) the rows of these results,
+        missing rows in between are unknown
+        """
+        if tail.step != self.step or tail.names != self.names:
+            raise ValueError('Can not merge results with different step or data sources')
+
+        nr_keep = min(max(0, (tail.from_ts - self.from_ts) // self.step), len(self.values))
+        nr_missing = max(0, (tail.from_ts - self.from_ts) // self.step - nr_keep)
+        columns = [_concatenate(c[:nr_keep], _unknown(nr_missing), t) for c, t in zip(self.columns, tail.columns)]
+        return RrdFetchResults.from_columns(self.names, min(self.from_ts, tail.from_ts), self.step, columns)
+
+    def since(self, from_ts):
+        """ Returns results without rows timed before from_ts
+        """
+        nr_skip = min(max(0, (from_ts - self.from_ts + self.step - 1) // self.step), len(self.values))
+        if nr_skip == 0:
+            return self
+        return RrdFetchResults.from_columns(self.names, self.from_ts + nr_skip * self.step, self.step,
+                                            [c[nr_skip:] for c in self.columns])
 
     @property
     def from_dt(self):
-        return date_util.datetime_from_timestamp(self.raw_data[0][0])
+        return date_util.datetime_from_timestamp(self.from_ts)
 
     @property
     def to_dt(self):
-        return date_util.datetime_from_timestamp(self.raw_data[0][1])
+        return date_util.datetime_from_timestamp(self.to_ts)
 
     @property
-    def step(self):
-        return int(self.raw_data[0][2])
+    def name(self):
+        return self.names[0]
 
     @property
-    def name(self):
-        return self.raw_data[1][0]
+    def values(self):
+        return self.columns[0]
+
+    @property
+    def timestamps(self):
+        if np is not None:
+            return self.from_ts + self.step * np.arange(len(self.values), dtype=np.int64)
+        return array('l', xrange(self.from_ts, self.from_ts + self.step * len(self.values), self.step))
 
     @property
     def result(self):
-        return self.raw_data[2]
+        return [tuple(row) for row in zip(*[_nan_to_none(c) for c in self.columns])]
 
-    def to_json_dict(self, only_data=False):
+    def column(self, name):
+        return self.columns[self.names.index(name)]
+
+    def select(self, names):
+        """ Returns results with only the named data sources (in the given order)
+        """
+        return RrdFetchResults.from_columns(names, self.from_ts, self.step, [self.column(n) for n in names])
+
+    def to_json_dict(self, only_data=False, drop_gaps=False, points=None):
+        """ only_data returns [[timestamp in ms, value], ...] pairs for charts, with drop_gaps consecutive
+        unknown values are collapsed to a single one (still breaks the line in the chart), with points
+        the pairs are decimated to at most that many (see decimate_min_max)
+        """
         if only_data:
-            d = []
-            start = date_util.timestamp(self.from_dt)
-            end = date_util.timestamp(self.to_dt)
-            i = 0
-            for t in xrange(start, end, self.step):
-                d.append((t * 1000, self.raw_data[2][i][0]))
-                i += 1
-            return d
+            timestamps, values = self.timestamps, self.values
+            if points is not None:
+                timestamps, values = decimate_min_max(timestamps, values, points)
+            return _to_pairs(timestamps, values, drop_gaps)
         else:
             return mj.encode_dict({
-                'from': self.from_dt,
-                'to': self.to_dt,
+                'from': self.from_ts,
+                'to': self.to_ts,
                 'step': self.step,
-                'data': [i[0] for i in self.result]
+                'data': _nan_to_none(self.values)
             })
 
+    def to_binary_dict(self, points=None):
+        """ Values packed as float32 (see encode_float32), value i is timed at from + i * step, with points
+        the values are decimated to at most that many (see decimate_min_max_grid)
+        """
+        values, step = self.values, self.step
+        if points is not None:
+            values, step = decimate_min_max_grid(values, step, points)
+        return {
+            'from': self.from_ts,
+            'step': step,
+            'values': encode_float32(values)
+        }
+
     def __repr__(self):
-        return self.raw_data.__repr__()
+        return '<RrdFetchResults %s [%d - %d, step %d] %d rows>' % (
+            ','.join(self.names), self.from_ts, self.to_ts, self.step, len(self.values))
+
+
+def decimate_min_max(timestamps, values, points):
+    """ Splits the values into points / 2 buckets and keeps the minimum and maximum of every bucket (in time
+    order), peaks stay visible in a chart of that many pixels. Buckets without known values are a single
+    unknown value.
+    """
+    if len(values) <= max(points, 1):
+        return timestamps, values
+
+    size, first, second = _min_max_positions(values, points)
+    if np is not None:
+        positions = np.empty(2 * len(first), dtype=np.int64)
+        positions[0::2] = first
+        positions[1::2] = second
+        keep = np.ones(len(positions), dtype=bool)
+        keep[1::2] = second != first
+        positions = positions[keep]
+        return np.asarray(timestamps)[positions], np.asarray(values)[positions]
+
+    positions = []
+    for f, s in izip(first, second):
+        positions.extend([f] if f == s else [f, s])
+    return [timestamps[i] for i in positions], [values[i] for i in positions]
+
+
+def decimate_min_max_grid(values, step, points):
+    """ As decimate_min_max, but the minimum and maximum (in time order) of a bucket are placed at its start
+    and middle, returns (values, step) of an evenly stepped series
+    """
+    if len(values) <= max(points, 1):
+        return values, step
+
+    size, first, second = _min_max_positions(values, points)
+    if np is not None:
+        values = np.asarray(values)
+        decimated = np.empty(2 * len(first), dtype=np.float64)
+        decimated[0::2] = values[first]
+        decimated[1::2] = values[second]
+    else:
+        decimated = array('d')
+        for f, s in izip(first, second):
+            decimated.extend((values[f], values[s]))
+    return decimated, size * step / 2.0
+
+
+def _min_max_positions(values, points):
+    """ Returns bucket size (number of values) and positions of the first and the second of the minimum and
+    maximum of every bucket (both at the start of a bucket without known values)
+    """
+    nr_buckets = max(1, points // 2)
+    size = (len(values) + nr_buckets - 1) // nr_buckets
+    nr_buckets = (len(values) + size - 1) // size
+
+    if np is not None:
+        values = np.asarray(values, dtype=np.float64)
+        padded = np.empty(nr_buckets * size, dtype=np.float64)
+        padded[:len(values)] = values
+        padded[len(values):] = np.nan
+        buckets = padded.reshape(nr_buckets, size)
+        unknown = np.isnan(buckets)
+
+        starts = np.arange(nr_buckets) * size
+        min_positions = starts + np.where(unknown, np.inf, buckets).argmin(axis=1)
+        max_positions = starts + np.where(unknown, -np.inf, buckets).argmax(axis=1)
+        gaps = unknown.all(axis=1)
+        min_positions[gaps] = max_positions[gaps] = starts[gaps]
+        return size, np.minimum(min_positions, max_positions), np.maximum(min_positions, max_positions)
+
+    first = []
+    second = []
+    for start in xrange(0, len(values), size):
+        known = [i for i in xrange(start, min(start + size, len(values))) if values[i] == values[i]]
+        if len(known) == 0:
+            positions = [start, start]
+        else:
+            positions = sorted([min(known, key=lambda i: values[i]), max(known, key=lambda i: values[i])])
+        first.append(positions[0])
+        second.append(positions[1])
+    return size, first, second
+
+
+def encode_float32(values):
+    """ Base64 of values packed as little endian float32, unknown values (None) are NaN
+    """
+    if np is not None:
+        packed = np.array(values, dtype=np.float64).astype('<f4').tobytes()
+    else:
+        packed = array('f', (NAN if v is None else v for v in values))
+        if sys.byteorder != 'little':
+            packed.byteswap()
+        packed = packed.tostring()
+    return base64.b64encode(packed)
+
+
+def _to_columns(rows, nr_columns):
+    if np is not None:
+        data = np.array(rows, dtype=np.float64).reshape(len(rows), nr_columns)
+        return [data[:, i] for i in xrange(nr_columns)]
+    return [array('d', (NAN if r[i] is None else r[i] for r in rows)) for i in xrange(nr_columns)]
+
+
+def _unknown(length):
+    if np is not None:
+        return np.full(length, np.nan)
+    return array('d', [NAN]) * length
+
+
+def _concatenate(*columns):
+    if np is not None:
+        return np.concatenate(columns)
+    return reduce(lambda a, b: a + b, columns)
+
+
+def _nan_to_none(values):
+    if np is not None:
+        values = np.asarray(values)
+        return np.where(np.isnan(values), None, values).tolist()
+    return [None if v != v else v for v in values]
+
+
+def _to_pairs(timestamps, values, drop_gaps):
+    if np is not None:
+        timestamps = np.asarray(timestamps) * 1000
+        values = np.asarray(values)
+        gaps = np.isnan(values)
+        if drop_gaps and len(values) > 0:
+            keep = ~gaps
+            keep[1:] |= gaps[1:] & ~gaps[:-1]
+            keep[0] = True
+            timestamps, values, gaps = timestamps[keep], values[keep], gaps[keep]
+        return zip(timestamps.tolist(), np.where(gaps, None, values).tolist())
+
+    pairs = []
+    previous_gap = False
+    for t, v in izip(timestamps, values):
+        gap = v != v
+        if gap:
+            if not (drop_gaps and previous_gap):
+                pairs.append((t * 1000, None))
+        else:
+            pairs.append((t * 1000, v))
+        previous_gap = gap
+    return pairs
 
 
 @login_manager.user_loader
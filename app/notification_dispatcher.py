@@ -0,0 +1,160 @@
+"""
+    Outbound notifications (e-mails, SMS) sent by one long-running thread.
+
+    Messages are stored in the outbound_message table (see models.OutboundMessage) on the measurement path,
+    so queued alarms survive a crash or restart. The dispatcher waits NOTIFICATION_BATCH_WINDOW seconds to
+    collect messages stored together and hands them over, grouped by kind, to the sender registered for the
+    kind (see register), e.g. all e-mails of a batch are rendered and sent over one SMTP connection. A message
+    is deleted once it is sent, failed messages are retried up to NOTIFICATION_MAX_ATTEMPTS times.
+"""
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from time import sleep
+
+from flask import current_app
+
+from . import db, thread_monitor, date_util
+from .models import OutboundMessage
+
+# set when messages are stored, None while the dispatcher is not running
+_wake = None
+_senders = {}
+_stats_lock = threading.Lock()
+_stats = {
+    'queued': 0,
+    'sent': 0,
+    'batches': 0,
+    'errors': 0,
+    'abandoned': 0
+}
+
+
+def _inc(key, value=1):
+    with _stats_lock:
+        _stats[key] += value
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['queue_depth'] = 0
+    if _wake is not None:
+        session = db.create_session({})
+        try:
+            stats['queue_depth'] = session.query(OutboundMessage).count()
+        finally:
+            session.close()
+    return stats
+
+
+def register(kind, send_batch):
+    """ send_batch(messages) sends a list of messages of the kind, returns the messages that were not sent
+    """
+    _senders[kind] = send_batch
+
+
+def start():
+    global _wake
+    if _wake is None:
+        _wake = threading.Event()
+    # messages left from before a restart
+    _wake.set()
+    thread_monitor.start_thread('Notification dispatcher', restart_on_exit=True, target=_run, args=(_wake,))
+
+
+def submit(kind, message):
+    if _wake is None:
+        # dispatcher is not running, send directly
+        _send({kind: [message]})
+        return
+
+    now = date_util.datetime_now()
+    session = db.create_session({})
+    try:
+        session.add(OutboundMessage(kind=kind, message=message, created_ts=now, nr_attempts=0, next_attempt_ts=now))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        current_app.logger.error('Could not queue %s message, sending it directly', kind)
+        current_app.logger.exception(e)
+        _send({kind: [message]})
+        return
+    finally:
+        session.close()
+
+    _inc('queued')
+    _wake.set()
+
+
+def _run(wake):
+    timeout = None
+    while True:
+        wake.wait(timeout)
+        wake.clear()
+        # take everything stored until the window is over
+        sleep(current_app.config['NOTIFICATION_BATCH_WINDOW'])
+
+        next_attempt_ts = dispatch()
+        if next_attempt_ts is None:
+            timeout = None
+        else:
+            timeout = max(0, (next_attempt_ts - date_util.datetime_now()).total_seconds())
+
+
+def dispatch():
+    """ Sends the messages due, returns when the next one is due (None if the queue is empty)
+    """
+    session = db.create_session({})
+    try:
+        now = date_util.datetime_now()
+        queued = session.query(OutboundMessage) \
+            .filter(OutboundMessage.next_attempt_ts <= now) \
+            .order_by(OutboundMessage.id) \
+            .limit(current_app.config['NOTIFICATION_BATCH_SIZE']).all()
+        # no transaction is kept open while sending
+        session.expunge_all()
+        session.commit()
+
+        if len(queued) > 0:
+            batch = defaultdict(list)
+            for m in queued:
+                batch[m.kind].append(m.message)
+            failed = set(id(message) for messages in _send(batch).itervalues() for message in messages)
+
+            for m in queued:
+                if id(m.message) not in failed:
+                    session.query(OutboundMessage).filter(OutboundMessage.id == m.id).delete()
+                elif m.nr_attempts + 1 >= current_app.config['NOTIFICATION_MAX_ATTEMPTS']:
+                    current_app.logger.error('Giving up sending %s message %s after %d attempts',
+                                             m.kind, m.id, m.nr_attempts + 1)
+                    _inc('abandoned')
+                    session.query(OutboundMessage).filter(OutboundMessage.id == m.id).delete()
+                else:
+                    retry_seconds = current_app.config['NOTIFICATION_RETRY_SECONDS'] * (m.nr_attempts + 1)
+                    session.query(OutboundMessage).filter(OutboundMessage.id == m.id).update({
+                        'nr_attempts': m.nr_attempts + 1,
+                        'next_attempt_ts': now + timedelta(seconds=retry_seconds)
+                    })
+            session.commit()
+
+        return session.query(db.func.min(OutboundMessage.next_attempt_ts)).scalar()
+    finally:
+        session.close()
+
+
+def _send(batch):
+    """ Returns {kind: [messages not sent]}
+    """
+    _inc('batches')
+    failed = {}
+    for kind, messages in batch.iteritems():
+        try:
+            failed[kind] = _senders[kind](messages)
+        except Exception as e:
+            current_app.logger.error('Sending %d %s messages failed', len(messages), kind)
+            current_app.logger.exception(e)
+            failed[kind] = messages
+        _inc('sent', len(messages) - len(failed[kind]))
+        _inc('errors', len(failed[kind]))
+    return failed
@@ -0,0 +1,210 @@
+"""
+    Background writer for RRD databases.
+
+    Measurements are put in a bounded queue and grouped per RRD file. Each file is then written with one
+    multi-value rrdtool update, either when enough samples are pending, when the oldest pending sample is
+    older than RRDTOOL_WRITER_FLUSH_SECONDS or when a flush is requested (on shutdown).
+
+    With RRDTOOL_GROUP_SENSORS samples of all sensors in a database are aligned to the step and written as
+    one row per step. Rows of a step still in progress are held until the step is over (or a flush is
+    requested), samples arriving for an already written step are dropped.
+"""
+import Queue
+import threading
+from time import time
+
+from flask import current_app
+
+from . import rrddb, thread_monitor
+from .date_util import timestamp, datetime_from_timestamp
+
+_FLUSH = object()
+
+NAN = float('nan')
+
+_queue = None
+_stats_lock = threading.Lock()
+_stats = {
+    'submitted': 0,
+    'dropped': 0,
+    'written': 0,
+    'coalesced': 0,
+    'flushes': 0,
+    'errors': 0,
+    'pending': 0
+}
+
+
+class _PendingFile(object):
+    def __init__(self, path, step, align):
+        self.path = path
+        self.step = step
+        self.align = align
+        self.sources = {}
+        # timestamp: {data source name: value}
+        self.rows = {}
+
+    def add(self, rrddef, read_ts, value):
+        # use the most recent definition
+        self.sources[rrddef.name] = rrddb.get_data_source(rrddef)
+        ts = timestamp(read_ts)
+        if self.align:
+            ts = (ts + self.step - 1) // self.step * self.step
+        # rrdtool accepts only one value per second, keep the latest one
+        self.rows.setdefault(ts, {})[rrddef.name] = value
+
+    def take_rows(self, last_ts, until_ts):
+        """ Removes (timestamp, {name: value}) rows timed until until_ts (all when None), returns those
+        newer than last_ts
+        """
+        taken = []
+        for ts in sorted(self.rows):
+            if until_ts is not None and ts > until_ts:
+                break
+            values = self.rows.pop(ts)
+            if last_ts is None or ts > last_ts:
+                taken.append((ts, values))
+        return taken
+
+
+def _inc(key, value=1):
+    with _stats_lock:
+        _stats[key] += value
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['queue_depth'] = _queue.qsize() if _queue is not None else 0
+    return stats
+
+
+def start():
+    global _queue
+    if _queue is None:
+        _queue = Queue.Queue(maxsize=current_app.config['RRDTOOL_WRITER_QUEUE_SIZE'])
+    thread_monitor.start_thread('RRD writer', restart_on_exit=True, target=_run, args=(_queue,))
+
+
+def submit(rrddef, read_ts, value):
+    if _queue is None:
+        # writer is not running, write directly
+        rrddb.add_many(rrddef, [(read_ts, value)])
+        return
+
+    try:
+        _queue.put_nowait((rrddef, read_ts, value))
+        _inc('submitted')
+    except Queue.Full:
+        _inc('dropped')
+        current_app.logger.warning('RRD writer queue is full, dropping sample for %s', rrddef.name)
+
+
+def flush(timeout=None):
+    """ Writes all pending samples, blocks until done (or timeout)
+    """
+    if _queue is None:
+        return True
+    done = threading.Event()
+    _queue.put((_FLUSH, done))
+    done.wait(timeout)
+    return done.is_set()
+
+
+def _run(queue):
+    last_written = {}
+    pending = {}
+    nr_pending = 0
+    # values held back by the last write (steps not over yet)
+    nr_held = 0
+    first_pending_at = None
+
+    while True:
+        flush_seconds = current_app.config['RRDTOOL_WRITER_FLUSH_SECONDS']
+        if first_pending_at is None:
+            timeout = None
+        else:
+            timeout = max(0, first_pending_at + flush_seconds - time())
+
+        try:
+            item = queue.get(timeout=timeout)
+        except Queue.Empty:
+            item = None
+
+        flush_done = None
+        if item is not None and item[0] is _FLUSH:
+            flush_done = item[1]
+        elif item is not None:
+            rrddef, read_ts, value = item
+            pending_file = pending.get(rrddef.path)
+            if pending_file is None:
+                pending_file = pending[rrddef.path] = _PendingFile(rrddef.path, rrddef.step,
+                                                                   current_app.config['RRDTOOL_GROUP_SENSORS'])
+            pending_file.add(rrddef, read_ts, value)
+            nr_pending += 1
+            if first_pending_at is None:
+                first_pending_at = time()
+
+        if flush_done is not None \
+                or nr_pending - nr_held >= current_app.config['RRDTOOL_WRITER_BATCH_SIZE'] \
+                or (first_pending_at is not None and time() - first_pending_at >= flush_seconds):
+            nr_pending = nr_held = _write(pending, last_written, nr_pending, flush_done is not None)
+            first_pending_at = time() if nr_pending > 0 else None
+
+        with _stats_lock:
+            _stats['pending'] = nr_pending
+
+        if flush_done is not None:
+            try:
+                rrddb.flush()
+            except Exception as e:
+                current_app.logger.exception(e)
+            flush_done.set()
+
+
+def _write(pending, last_written, nr_pending, flush_all):
+    """ Returns the number of values still pending (in steps not over yet)
+    """
+    now = int(time())
+    written = 0
+    failed = 0
+    for path, pending_file in pending.items():
+        if path not in last_written:
+            # the database may have been updated before a restart
+            try:
+                last_written[path] = rrddb.get_last_update(path)
+            except Exception as e:
+                current_app.logger.exception(e)
+        last_ts = last_written.get(path)
+        # rrdtool rejects the whole update if any row is not newer than the last update
+        rows = pending_file.take_rows(last_ts, None if flush_all or not pending_file.align else now)
+        if len(pending_file.rows) == 0:
+            del pending[path]
+        if len(rows) == 0:
+            continue
+
+        names = sorted(set(name for ts, values in rows for name in values))
+        nr_values = sum(len(values) for ts, values in rows)
+        try:
+            skipped = rrddb.write_rows(path, pending_file.step, [pending_file.sources[name] for name in names],
+                                       [(datetime_from_timestamp(ts), [values.get(name, NAN) for name in names])
+                                        for ts, values in rows])
+            last_written[path] = rows[-1][0]
+            # values of data sources that could not be added to the database
+            nr_skipped = sum(1 for ts, values in rows for name in skipped if name in values)
+            if nr_skipped > 0:
+                _inc('errors')
+            written += nr_values - nr_skipped
+            failed += nr_skipped
+        except Exception as e:
+            failed += nr_values
+            _inc('errors')
+            current_app.logger.exception(e)
+
+    nr_left = sum(len(values) for pending_file in pending.itervalues()
+                  for values in pending_file.rows.itervalues())
+    with _stats_lock:
+        _stats['written'] += written
+        _stats['coalesced'] += nr_pending - written - failed - nr_left
+        _stats['flushes'] += 1
+    return nr_left
@@ -1,33 +1,48 @@
-import textwrap
+from itertools import islice
 from os.path import isfile
 from datetime import timedelta
 
-import rrdtool
 from flask import current_app
-from .models import RrdFetchResults
 from .date_util import timestamp
 from . import date_util
+from .timeseries import Archive, DataSource, format_definition, get_backend
 
 
 class RrdDefinitionException(Exception):
     pass
 
 
-def _get_start_file_name(rrddef):
-    return str(rrddef.path) + '.startts'
+def _get_start_file_name(path):
+    return str(path) + '.startts'
 
 
-def generate_definition(rrddef):
-    step = rrddef.step
-    rras = []
-    cfs = current_app.config['RRDTOOL_DEFAULT_CFS']
-    for resolution in current_app.config['RRDTOOL_DATABASE_RESOLUTIONS']:
-        for cf in cfs:
-            rras.append(generate_rra(step, cf, resolution[1], resolution[0]))
+def _backend():
+    return get_backend(current_app.config['TIMESERIES_BACKEND'])
+
+
+# names of data sources per database path
+_sources = {}
+
+
+def get_archives(rrddef):
+    return _get_archives(rrddef.step)
+
+
+def _get_archives(step):
+    archives = []
+    for values_to_summarize, days_to_keep in current_app.config['RRDTOOL_DATABASE_RESOLUTIONS']:
+        for cf in current_app.config['RRDTOOL_DEFAULT_CFS']:
+            archives.append(Archive(cf, values_to_summarize,
+                                    (days_to_keep * 24 * 60 * 60) / (step * values_to_summarize)))
+    return archives
+
 
-    return '\n'.join(['DS:{name:s}:GAUGE:{missed:d}:{mmin:f}:{mmax:f}'.format(name=rrddef.name, missed=step * 2,
-                                                                              mmin=rrddef.mmin,
-                                                                              mmax=rrddef.mmax)] + rras)
+def get_data_source(rrddef):
+    return DataSource(rrddef.name, rrddef.mmin, rrddef.mmax)
+
+
+def generate_definition(rrddef):
+    return format_definition(rrddef.step, [get_data_source(rrddef)], get_archives(rrddef))
 
 
 def generate_rra(step, cf, days_to_keep, values_to_summarize):
@@ -43,96 +58,267 @@ def init(rrddef, start=None):
     if rrddef.path is None:
         raise RrdDefinitionException('Path for RRD is not defined')
 
-    definition = generate_definition(rrddef)
-
-    rrd_args = textwrap.dedent(definition).split('\n')
-    rrd_args = filter(len, rrd_args)
-
-    if start is not None:
-        rrd_args.insert(0, '--start')
-        rrd_args.insert(1, str(timestamp(start)))
-
     current_app.logger.info('Initializing RRD DB')
 
-    if isfile(rrddef.path):
+    if is_rrd_initialized(rrddef):
         current_app.logger.info('Using existing RRD DB')
     else:
+        init_sources(rrddef.path, rrddef.step, [get_data_source(rrddef)], start)
+        current_app.logger.info('RRD DB initialized')
+
+
+def check_backend():
+    """ Raises RrdDefinitionException when the configured backend cannot store the configured layout
+    """
+    if current_app.config['RRDTOOL_GROUP_SENSORS'] and not _backend().can_add_sources():
+        raise RrdDefinitionException('RRDTOOL_GROUP_SENSORS needs a backend able to add data sources to a '
+                                     'database, %s cannot (rrdtool 1.5+ is required)'
+                                     % (current_app.config['TIMESERIES_BACKEND'],))
+
+
+def init_sources(path, step, sources, start=None):
+    """ Creates the database with the data sources or adds the missing ones to an existing database
+    """
+    if not _backend().is_initialized(path):
         if start is not None:
-            start_file = _get_start_file_name(rrddef)
+            start_file = _get_start_file_name(path)
             # write the timestamp
             with open(start_file, mode='w') as sf:
                 sf.write(str(timestamp(start)))
-        rrdtool.create(rrddef.path, '--step', str(rrddef.step), '--no-overwrite', *rrd_args)
-        current_app.logger.info('RRD DB initialized')
+        _backend().create(path, step, sources, _get_archives(step), None if start is None else timestamp(start))
+    else:
+        known = get_sources(path)
+        missing = [s for s in sources if s.name not in known]
+        if len(missing) > 0:
+            current_app.logger.info('Adding %s to %s', ', '.join(s.name for s in missing), path)
+            _backend().add_sources(path, step, missing, _get_archives(step))
+    _sources.pop(path, None)
+
+
+def get_sources(path):
+    """ Names of data sources in the database (cached)
+    """
+    names = _sources.get(path)
+    if names is None:
+        names = _sources[path] = frozenset(_backend().get_sources(path))
+    return names
 
 
 def is_rrd_initialized(rrddef):
-    return isfile(rrddef.path)
+    if not _backend().is_initialized(rrddef.path):
+        _sources.pop(rrddef.path, None)
+        return False
+    return rrddef.name in get_sources(rrddef.path)
 
 
 def add(measurement, rrddef):
+    add_many(rrddef, [(measurement.read_ts, measurement.value)])
+
+
+def add_many(rrddef, samples):
+    """ Writes (datetime, value) samples, ordered by time, with a single update call
+    """
+    write_rows(rrddef.path, rrddef.step, [get_data_source(rrddef)], [(ts, [value]) for ts, value in samples])
+
+
+def write_rows(path, step, sources, rows):
+    """ Writes (datetime, [value per data source]) rows, ordered by time, with a single update call,
+    unknown values are NaN. When data sources cannot be added to an existing database, values of the other
+    data sources are still written, returns names of the data sources not written.
+    """
+    skipped = []
+    if len(rows) == 0:
+        return skipped
+
     # Check if initialization is needed
-    if not is_rrd_initialized(rrddef):
+    if not _backend().is_initialized(path) or any(s.name not in get_sources(path) for s in sources):
         # Warning at initialization with start time:
         # RRDtool will not accept any data timed before or at the time specified.
         # source: http://oss.oetiker.ch/rrdtool/doc/rrdcreate.en.html#___top
+        try:
+            init_sources(path, step, sources, rows[0][0] - timedelta(seconds=1))
+        except Exception as e:
+            known = get_sources(path) if _backend().is_initialized(path) else frozenset()
+            indexes = [i for i, s in enumerate(sources) if s.name in known]
+            if len(indexes) == 0:
+                raise
+            current_app.logger.exception(e)
+            skipped = [s.name for s in sources if s.name not in known]
+            sources = [sources[i] for i in indexes]
+            rows = [(ts, [values[i] for i in indexes]) for ts, values in rows]
 
-        init(rrddef, measurement.read_ts - timedelta(seconds=1))
+    _backend().update(path, [s.name for s in sources], [(timestamp(ts), values) for ts, values in rows])
 
-    query = generate_update_query(measurement.read_ts, measurement.value)
+    current_app.logger.log(6, '%d rows written to %s', len(rows), path)
+    return skipped
 
-    # current_app.logger.debug('Write command for RRD %s', query)
 
-    rrdtool.update(rrddef.path, query)
+def flush():
+    _backend().flush()
 
-    current_app.logger.log(6, 'Command %s written. Last inserted value in RRD at timestamp %s', query,
-                           rrdtool.last(rrddef.path))
 
-
-def generate_update_query(ts, value):
-    return '{:d}:{:f}'.format(timestamp(ts), value)
+def get_last_update(path):
+    """ Timestamp of the last update of the database (or None if it is not initialized)
+    """
+    if not _backend().is_initialized(path):
+        return None
+    return _backend().last(path)[0]
 
 
 def fetch_last(rrddef):
-    info = rrdtool.info(rrddef.path)
-    try:
-        value = info['ds[%s].last_ds' % (rrddef.name,)]
-    except ValueError, e:
-        current_app.logger.exception(e)
-        value = None
-    ts = date_util.datetime_from_timestamp(int(info['last_update']))
-    return ts, value
+    ts, values = _backend().last(rrddef.path)
+    return date_util.datetime_from_timestamp(ts), values.get(rrddef.name)
 
 
-def fetch(rrddef, cf, period_td, resolution_td=None, to_dt=None, use_real_start=False):
-    if to_dt is None:
-        to_dt = date_util.datetime_now()
+def get_resolution(rrddef, period_td):
+    """ Resolution (in seconds) of the RRA that keeps at least period_td of data
+    """
+    resolutions = current_app.config['RRDTOOL_DATABASE_RESOLUTIONS']
+    possible_periods = [pair[0] for pair in resolutions if pair[1] >= period_td.days]
+    if len(possible_periods) == 0:
+        possible_periods = [resolutions[-1][0]]
+    return rrddef.step * min(possible_periods)
+
+
+def get_real_start_ts(rrddef):
+    """ Timestamp of the first value written into the RRD (or None if not known)
+    """
+    if isfile(_get_start_file_name(rrddef.path)):
+        # read the timestamp
+        with open(_get_start_file_name(rrddef.path), 'r') as sf:
+            return int(sf.read())
+    return None
 
-    if resolution_td is None:
-        resolutions = current_app.config['RRDTOOL_DATABASE_RESOLUTIONS']
-        possible_periods = [pair[0] for pair in resolutions if pair[1] >= period_td.days]
-        if len(possible_periods) == 0:
-            possible_periods = [resolutions[-1][0]]
-        resolution_td = timedelta(seconds=rrddef.step * min(possible_periods))
 
-    resolution = int(resolution_td.total_seconds())
+def get_first_ts(rrddef, resolution):
+    """ Oldest timestamp kept by the archive used for the resolution (or of the first value written when
+    it is later)
+    """
+    resolutions = sorted(current_app.config['RRDTOOL_DATABASE_RESOLUTIONS'])
+    # backends use the closest coarser archive, the coarsest when there is none
+    kept = [pair for pair in resolutions if rrddef.step * pair[0] >= resolution] or [resolutions[-1]]
+    first_ts = get_last_update(rrddef.path) - kept[0][1] * 24 * 60 * 60
+    real_start_ts = get_real_start_ts(rrddef)
+    return first_ts if real_start_ts is None else max(first_ts, real_start_ts)
+
+
+def align_ts(ts, resolution):
     """
      end time == int(t/900)*900,
      start time == end time - 1hour,
      resolution == 900.
     """
+    return int(ts / resolution) * resolution
+
 
-    to_ts = int(timestamp(to_dt) / resolution) * resolution
+def fetch(rrddef, cf, period_td, resolution_td=None, to_dt=None, use_real_start=False):
+    if to_dt is None:
+        to_dt = date_util.datetime_now()
+
+    if resolution_td is None:
+        resolution = get_resolution(rrddef, period_td)
+    else:
+        resolution = int(resolution_td.total_seconds())
+
+    to_ts = align_ts(timestamp(to_dt), resolution)
     from_ts_base = to_ts - period_td.total_seconds()
 
     if use_real_start:
-        if isfile(_get_start_file_name(rrddef)):
-            # read the timestamp
-            with open(_get_start_file_name(rrddef), 'r') as sf:
-                from_ts_base = int(sf.read())
+        real_start_ts = get_real_start_ts(rrddef)
+        if real_start_ts is not None:
+            from_ts_base = real_start_ts
+
+    return fetch_range(rrddef, cf, resolution, align_ts(from_ts_base, resolution), to_ts)
 
-    from_ts = int(from_ts_base / resolution) * resolution
 
+def fetch_range(rrddef, cf, resolution, from_ts, to_ts):
+    return fetch_all_range(rrddef.path, cf, resolution, from_ts, to_ts).select([rrddef.name])
+
+
+def fetch_all_range(path, cf, resolution, from_ts, to_ts):
+    """ Returns all data sources (sensors) of the database in one fetch
+    """
     assert (to_ts > from_ts)
 
-    return RrdFetchResults(rrdtool.fetch(rrddef.path, cf, '-r', str(resolution), '-s', str(from_ts), '-e', str(to_ts)))
+    return _backend().fetch(path, cf, resolution, from_ts, to_ts)
+
+
+def copy_into(rrddefs, path, step):
+    """ Writes series of single sensor databases (rrddefs) into a new database at path with a data source
+    per sensor. Archives are read from the finest to the coarsest resolution, every period is taken from the
+    finest archive that keeps it (consolidated values of the first of RRDTOOL_DEFAULT_CFS). A row of a coarse
+    archive is written as its value at every step it covers, updates further apart than the heartbeat (two
+    steps) would be stored as unknown. Returns the number of rows written.
+    """
+    if _backend().is_initialized(path):
+        raise RrdDefinitionException('Database %s already exists' % (path,))
+
+    cf = current_app.config['RRDTOOL_DEFAULT_CFS'][0]
+    # runs of (first step, last step, value) per sensor, timestamps of the steps
+    runs = []
+    for rrddef in rrddefs:
+        sensor_runs = []
+        last_ts = timestamp(fetch_last(rrddef)[0])
+        # steps from covered_from on are taken from a finer archive
+        covered_from = None
+        for values_to_summarize, days_to_keep in sorted(current_app.config['RRDTOOL_DATABASE_RESOLUTIONS']):
+            resolution = step * values_to_summarize
+            from_ts = align_ts(last_ts - days_to_keep * 24 * 60 * 60, resolution)
+            to_ts = last_ts + resolution if covered_from is None else covered_from
+            if from_ts >= to_ts:
+                continue
+            results = fetch_range(rrddef, cf, resolution, from_ts, to_ts)
+            for ts, value in zip(results.timestamps, results.values):
+                # value of the row is consolidated at its end, a row overlapping the finer archive is cut
+                first_ts = int(ts) + step
+                end_ts = int(ts) + results.step if covered_from is None else \
+                    min(int(ts) + results.step, covered_from - step)
+                if first_ts <= end_ts and value == value:
+                    sensor_runs.append((first_ts, end_ts, value))
+            covered_from = results.from_ts + results.step
+        runs.append(sorted(sensor_runs))
+
+    sources = [get_data_source(rrddef) for rrddef in rrddefs]
+    rows = _expand_runs(runs, step)
+    nr_rows = 0
+    while True:
+        chunk = [(date_util.datetime_from_timestamp(ts), values) for ts, values in islice(rows, 1000)]
+        if len(chunk) == 0:
+            break
+        write_rows(path, step, sources, chunk)
+        nr_rows += len(chunk)
+    flush()
+    return nr_rows
+
+
+def _expand_runs(runs, step):
+    """ Yields (timestamp, [value per sensor]) for every step covered by a run of any sensor, runs of a sensor
+    are (first timestamp, last timestamp, value) ordered by time
+    """
+    positions = [0] * len(runs)
+    starts = [r[0][0] for r in runs if len(r) > 0]
+    if len(starts) == 0:
+        return
+    ts = min(starts)
+    while ts is not None:
+        values = []
+        next_ts = None
+        for i, sensor_runs in enumerate(runs):
+            p = positions[i]
+            while p < len(sensor_runs) and sensor_runs[p][1] < ts:
+                p += 1
+            positions[i] = p
+            if p == len(sensor_runs):
+                values.append(float('nan'))
+                continue
+            first, last, value = sensor_runs[p]
+            if first <= ts:
+                values.append(value)
+                candidate = ts + step
+            else:
+                values.append(float('nan'))
+                candidate = first
+            next_ts = candidate if next_ts is None else min(next_ts, candidate)
+        if any(v == v for v in values):
+            yield ts, values
+        ts = next_ts
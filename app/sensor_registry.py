@@ -0,0 +1,69 @@
+"""
+    Process-wide registry of sensors keyed by sensor code.
+
+    Sensors are loaded once (together with their SensorType) in a short-lived session of their own and are
+    detached, so lookups on the measurement path do not touch the database or the caller's session.
+    Call invalidate() whenever sensor settings are changed.
+"""
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy.orm import joinedload
+
+from . import db
+from .models import Sensor
+
+_lock = Lock()
+_sensors_by_code = None
+_generation = 0
+
+
+def _load():
+    session = db.create_session({})
+    try:
+        sensors = session.query(Sensor).options(joinedload(Sensor.type)).all()
+    finally:
+        # detaches the loaded objects
+        session.close()
+
+    current_app.logger.debug('Sensor registry loaded (%d sensors)', len(sensors))
+    return dict((s.sensor_code, s) for s in sensors)
+
+
+def _get_sensors():
+    global _sensors_by_code
+    sensors = _sensors_by_code
+    if sensors is None:
+        with _lock:
+            if _sensors_by_code is None:
+                _sensors_by_code = _load()
+            sensors = _sensors_by_code
+    return sensors
+
+
+def get(sensor_code):
+    return _get_sensors().get(sensor_code)
+
+
+def get_by_id(sensor_id):
+    for s in _get_sensors().itervalues():
+        if s.id == sensor_id:
+            return s
+    return None
+
+
+def get_all():
+    return sorted(_get_sensors().values(), key=lambda s: s.id)
+
+
+def generation():
+    """ Counter increased on every invalidation, useful as a cache key for data derived from sensor settings
+    """
+    return _generation
+
+
+def invalidate():
+    global _sensors_by_code, _generation
+    with _lock:
+        _sensors_by_code = None
+        _generation += 1
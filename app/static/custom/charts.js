@@ -1,5 +1,7 @@
 $(function () {
-    $.getJSON('history.json', function (obj) {
+    // series are decimated on the server to the width of the chart (in device pixels)
+    var points = Math.round(($('#main_chart').width() || $(window).width()) * (window.devicePixelRatio || 1));
+    $.getJSON('history.json', {points: points}, function (obj) {
         var series_data = obj.series, series = [],
             yAxes_data = obj.yAxes, yAxes = [],
             yAxes_top_padding = 5,
@@ -70,6 +72,13 @@ $(function () {
         });
         _.each(series_data, function (serie_data, index) {
             var chart_data = serie_data.data;
+            if (isUndefined(chart_data)) {
+                // packed series, value i is timed at from + i * step (seconds)
+                var decoded = decodeSeries(serie_data);
+                chart_data = _.map(decoded.data, function (value, i) {
+                    return [(decoded.from + i * decoded.step) * 1000, value];
+                });
+            }
             var serie = {
                 type: 'line',
                 name: serie_data.name,
@@ -581,6 +581,11 @@ var FarmaApp = Espresso.Controller.extend({
         socket.on('sensor update', function (data) {
             sensor_store.update(data);
         });
+        socket.on('sensor updates', function (data) {
+            for (var i = 0, l = data.length; i < l; i++) {
+                sensor_store.update(data[i]);
+            }
+        });
         socket.on('sensor update warning values', function (data) {
             sensor_store.update(data);
         });
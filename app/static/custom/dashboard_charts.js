@@ -231,9 +231,10 @@ var SensorChart = Espresso.extend(DefaultSensorChart, {
         if (isUndefined(this.initialData))
             return;
 
-        var start = this.initialData.from,
-            step = this.initialData.step,
-            data = this.initialData.data,
+        var history = decodeSeries(this.initialData),
+            start = history.from,
+            step = history.step,
+            data = history.data,
             chart_data = {'ser': [], 'ser-min': [], 'ser-max': []},
             date;
 
@@ -43,3 +43,25 @@ var isVisibleOnDevice = function (alias) {
     return $('#media-id-' + alias).is(':visible');
 };
 
+
+
+// Series packed by the server (series_encoding cookie 'f32'): {from, step, values} with values as base64 of little
+// endian float32 (NaN is unknown), returns {from, step, data} with unknown values as null. Other series are
+// returned as they are.
+var decodeSeries = function (series) {
+    if (isUndefined(series) || isUndefined(series.values)) {
+        return series;
+    }
+    var bytes = atob(series.values),
+        view = new DataView(new ArrayBuffer(bytes.length)),
+        data = new Array(bytes.length / 4),
+        i, value;
+    for (i = 0; i < bytes.length; i++) {
+        view.setUint8(i, bytes.charCodeAt(i));
+    }
+    for (i = 0; i < data.length; i++) {
+        value = view.getFloat32(i * 4, true);
+        data[i] = isNaN(value) ? null : value;
+    }
+    return {from: series.from, step: series.step, data: data};
+};
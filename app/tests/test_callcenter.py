@@ -0,0 +1,110 @@
+from unittest import TestCase
+import socket
+
+from flask import Flask
+
+from app import callcenter
+
+
+class FakeCall(object):
+    def __init__(self, sid, status):
+        self.sid = sid
+        self.status = status
+
+
+class FakeCalls(object):
+    """ Twilio calls resource, statuses of every created call are taken from the given list
+    """
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.created = []
+        self.updated = []
+
+    def create(self, to, from_, url):
+        self.created.append(to)
+        return FakeCall('CA%d' % len(self.created), 'queued')
+
+    def get(self, sid):
+        return FakeCall(sid, self.statuses.pop(0))
+
+    def update(self, sid, status):
+        self.updated.append((sid, status))
+
+
+class FailingCalls(FakeCalls):
+    def create(self, to, from_, url):
+        if to == 'bad':
+            raise socket.error('Connection reset by peer')
+        return FakeCalls.create(self, to, from_, url)
+
+
+class FakeClient(object):
+    def __init__(self, statuses):
+        self.calls = FakeCalls(statuses)
+
+
+class TestCallcenter(TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.config.update(MAKE_CALLS=True, TWILIO_FROM_PHONE='1', TWILIO_CALL_TWIML='', CALL_MAX_ATTEMPTS=2,
+                          CALL_POLL_SECONDS=3, CALL_POLL_MAX_SECONDS=12)
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.started = []
+        self.finished = []
+
+    def tearDown(self):
+        callcenter.calls.clear()
+        self.ctx.pop()
+
+    def make_a_call(self, to):
+        callcenter.make_a_call(to, lambda to, contact_id: self.started.append(contact_id),
+                               lambda to, contact_id: self.finished.append(contact_id), (7,))
+
+    def test_call_answered(self):
+        client = FakeClient(['ringing', 'ringing', 'in-progress'])
+        self.make_a_call('123')
+        self.make_a_call('123')
+
+        self.assertEqual(callcenter.get_calls_in_progress(), [{'id': '123'}])
+        self.assertEqual(callcenter.poll_calls(client, now=0), 3)
+        self.assertEqual(callcenter.poll_calls(client, now=3), 6)
+        self.assertEqual(callcenter.poll_calls(client, now=6), 12)
+        self.assertIsNone(callcenter.poll_calls(client, now=12))
+
+        self.assertEqual(client.calls.created, ['123'])
+        self.assertEqual(self.started, [7])
+        self.assertEqual(self.finished, [7])
+        self.assertEqual(callcenter.get_calls_in_progress(), [])
+
+    def test_call_repeated(self):
+        client = FakeClient(['busy', 'no-answer'])
+        self.make_a_call('123')
+
+        for now in [0, 3, 3, 6, 6]:
+            callcenter.poll_calls(client, now=now)
+
+        self.assertEqual(client.calls.created, ['123', '123'])
+        self.assertEqual(self.finished, [7])
+
+    def test_cancel_call(self):
+        client = FakeClient(['ringing'])
+        self.make_a_call('123')
+        callcenter.poll_calls(client, now=0)
+        callcenter.cancel_call('123')
+
+        self.assertIsNone(callcenter.poll_calls(client, now=1))
+        self.assertEqual(client.calls.updated, [('CA1', 'completed')])
+        self.assertEqual(self.finished, [7])
+
+    def test_call_error(self):
+        client = FakeClient(['in-progress'])
+        client.calls = FailingCalls(client.calls.statuses)
+        self.make_a_call('bad')
+        self.make_a_call('123')
+
+        self.assertEqual(callcenter.poll_calls(client, now=0), 3)
+        self.assertEqual(callcenter.get_calls_in_progress(), [{'id': '123'}])
+        self.assertIsNone(callcenter.poll_calls(client, now=3))
+        self.assertEqual(self.finished, [7, 7])
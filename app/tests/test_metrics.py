@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from flask import Flask
+from flask.ext.login import LoginManager
+
+from app.metrics import Histogram, render
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_histogram(self):
+        h = Histogram('test_seconds', 'Test', buckets=(0.1, 1))
+        for v in [0.05, 0.1, 0.5, 2]:
+            h.observe(v)
+
+        cumulative, total, count = h.snapshot()
+        self.assertEqual(cumulative, [2, 3, 4])
+        self.assertAlmostEqual(total, 2.65)
+        self.assertEqual(count, 4)
+
+    def test_render(self):
+        text = render([('test_queue_depth', 'Queue depth', 'gauge', 3, {'pool': 'relay'})])
+
+        self.assertIn('# TYPE test_queue_depth gauge', text)
+        self.assertIn('test_queue_depth{pool="relay"} 3.0', text)
+
+
+class TestMetricsView(TestCase):
+    def setUp(self):
+        from app.dashboard import dashboard
+
+        self.app = Flask(__name__)
+        self.app.config.update(SECRET_KEY='test', METRICS_TOKEN='secret')
+        LoginManager().init_app(self.app)
+        self.app.register_blueprint(dashboard)
+
+    def get(self, **headers):
+        return self.app.test_client().get('/metrics', headers=headers)
+
+    def test_token(self):
+        self.assertEqual(self.get().status_code, 401)
+        self.assertEqual(self.get(Authorization='Bearer wrong').status_code, 401)
+
+        response = self.get(Authorization='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE farmcontrol_rrd_writer_written_total counter', response.data)
+        self.assertIn('# TYPE farmcontrol_rrd_writer_queue_depth gauge', response.data)
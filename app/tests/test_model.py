@@ -14,6 +14,53 @@ class TestModel(TestCase):
         # TODO:
         pass
 
+    def test_rrd_fetch_results(self):
+        results = RrdFetchResults(((100, 150, 10), ('data',), [(1.0,), (None,), (None,), (2.0,), (None,)]))
+
+        self.assertEqual(results.name, 'data')
+        self.assertEqual(list(results.timestamps), [100, 110, 120, 130, 140])
+        self.assertEqual(results.to_json_dict()['data'], [1.0, None, None, 2.0, None])
+        self.assertEqual([list(p) for p in results.to_json_dict(only_data=True, drop_gaps=True)],
+                         [[100000, 1.0], [110000, None], [130000, 2.0], [140000, None]])
+
+    def test_rrd_fetch_results_merge(self):
+        results = RrdFetchResults(((100, 140, 10), ('data',), [(1.0,), (2.0,), (None,), (None,)]))
+        tail = RrdFetchResults(((120, 150, 10), ('data',), [(3.0,), (4.0,), (5.0,)]))
+
+        merged = results.merge(tail)
+        self.assertEqual(merged.from_ts, 100)
+        self.assertEqual(merged.to_json_dict()['data'], [1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(merged.since(125).from_ts, 130)
+        self.assertEqual(merged.since(125).to_json_dict()['data'], [4.0, 5.0])
+
+        gap = RrdFetchResults(((170, 180, 10), ('data',), [(6.0,)]))
+        self.assertEqual(results.merge(gap).to_json_dict()['data'], [1.0, 2.0, None, None, None, None, None, 6.0])
+
+    def test_rrd_fetch_results_decimate(self):
+        values = [float(i % 10) for i in xrange(40)]
+        values[25] = 50.0
+        values[30:40] = [None] * 10
+        results = RrdFetchResults(((0, 400, 10), ('data',), [(v,) for v in values]))
+
+        self.assertEqual([list(p) for p in results.to_json_dict(only_data=True, drop_gaps=True, points=8)],
+                         [[0, 0.0], [90000, 9.0], [100000, 0.0], [190000, 9.0], [200000, 0.0], [250000, 50.0],
+                          [300000, None]])
+        self.assertEqual(len(results.to_json_dict(only_data=True, points=40)), 40)
+
+    def test_rrd_fetch_results_binary(self):
+        results = RrdFetchResults(((100, 150, 10), ('data',), [(1.5,), (None,), (2.0,)]))
+        encoded = results.to_binary_dict()
+
+        self.assertEqual((encoded['from'], encoded['step']), (100, 10))
+        values = array('f', base64.b64decode(encoded['values']))
+        self.assertEqual(values[0], 1.5)
+        self.assertNotEqual(values[1], values[1])
+        self.assertEqual(values[2], 2.0)
+
+        results = RrdFetchResults(((0, 400, 10), ('data',), [(float(i),) for i in xrange(40)]))
+        self.assertEqual(results.to_binary_dict(points=8)['step'], 50)
+        self.assertEqual(len(base64.b64decode(results.to_binary_dict(points=8)['values'])), 4 * 8)
+
     def test_sensor(self):
         s = Sensor()
         s.rrd_db_path = '../debug/zgt.rrd'
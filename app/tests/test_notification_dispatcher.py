@@ -0,0 +1,54 @@
+from unittest import TestCase
+import shutil
+import tempfile
+import threading
+
+from flask import Flask
+
+from app import db, notification_dispatcher
+from app.models import OutboundMessage
+
+
+class TestNotificationDispatcher(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        app = Flask(__name__)
+        app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///%s/data.sqlite' % (self.dir,), SQLITE_POOL_SIZE=0,
+                          NOTIFICATION_BATCH_SIZE=200, NOTIFICATION_RETRY_SECONDS=60, NOTIFICATION_MAX_ATTEMPTS=2)
+        db.init_app(app)
+        self.ctx = app.app_context()
+        self.ctx.push()
+        OutboundMessage.__table__.create(db.get_engine(app))
+
+        self.sent = []
+        notification_dispatcher.register('test', self.send)
+        notification_dispatcher._wake = threading.Event()
+
+    def tearDown(self):
+        notification_dispatcher._wake = None
+        self.ctx.pop()
+        shutil.rmtree(self.dir)
+
+    def send(self, messages):
+        self.sent.extend(m for m in messages if m != 'bad')
+        return [m for m in messages if m == 'bad']
+
+    def test_queue(self):
+        notification_dispatcher.submit('test', 'first')
+        notification_dispatcher.submit('test', 'bad')
+        # stored until sent
+        self.assertEqual(notification_dispatcher.get_stats()['queue_depth'], 2)
+        self.assertTrue(notification_dispatcher._wake.is_set())
+
+        next_attempt_ts = notification_dispatcher.dispatch()
+        self.assertEqual(self.sent, ['first'])
+        self.assertIsNotNone(next_attempt_ts)
+        self.assertEqual([(m.message, m.nr_attempts) for m in OutboundMessage.query.all()], [('bad', 1)])
+
+        # not due yet, given up after the second attempt
+        self.assertEqual(notification_dispatcher.dispatch(), next_attempt_ts)
+        OutboundMessage.query.update({'next_attempt_ts': next_attempt_ts.replace(year=2000)})
+        db.session.commit()
+
+        self.assertIsNone(notification_dispatcher.dispatch())
+        self.assertEqual(OutboundMessage.query.count(), 0)
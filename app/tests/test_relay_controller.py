@@ -1,6 +1,11 @@
 from unittest import TestCase
+from collections import deque
+from StringIO import StringIO
+
+from flask import Flask
 
 from app.hardware.relay_controller import *
+from app.hardware.relay_controller import _next_batch
 from app.models import RelayState, Relay
 
 
@@ -34,3 +39,58 @@ class TestRelayController(TestCase):
             self.assertIn(response.state, [RelayState.On, RelayState.Off])
 
         get_relay_state(self.relay, check_response)
+
+
+class FakeSerial(StringIO):
+    def __init__(self, response):
+        StringIO.__init__(self, response)
+        self.written = ''
+
+    def flushInput(self):
+        pass
+
+    def write(self, data):
+        self.written += data
+
+
+class TestRelayBoardConnection(TestCase):
+    def setUp(self):
+        self.ctx = Flask(__name__).app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def test_execute_pipelined(self):
+        # the board answers the queries written at once in its own order, with noise in between
+        connection = RelayBoardConnection('/dev/null', 9600)
+        connection.ser = FakeSerial('7_OF\r\n\r\n13_\r\n13_ON\r\n8_ON\r\n')
+        commands = [RelayCommand(create_query(pin, 'STATE'), 5) for pin in (13, 7, 8, 9)]
+
+        repeat = connection.execute(commands)
+
+        self.assertEqual(connection.ser.written, 'a13_2-a7_2-a8_2-a9_2-')
+        self.assertEqual([(c.response.pin, c.response.state) for c in commands[:3]],
+                         [(13, RelayState.On), (7, RelayState.Off), (8, RelayState.On)])
+        self.assertEqual(repeat, [commands[3]])
+        self.assertFalse(commands[3].done.is_set())
+
+    def test_cancelled_not_written(self):
+        connection = RelayBoardConnection('/dev/null', 9600)
+        connection.ser = FakeSerial('7_ON\r\n')
+        switch_command = RelayCommand(create_query(13, RelayState.PendingOn), 5)
+        state_command = RelayCommand(create_query(7, 'STATE'), 5)
+        switch_command.cancel()
+
+        backlog = deque([switch_command, state_command])
+        batch = _next_batch(backlog)
+        self.assertEqual(batch, [state_command])
+        self.assertEqual(len(backlog), 0)
+
+        self.assertEqual(connection.execute([switch_command, state_command]), [])
+        self.assertEqual(connection.ser.written, 'a7_2-')
+        self.assertFalse(switch_command.done.is_set())
+
+    def test_parse_states_response(self):
+        states = parse_relay_states_response('7_OF\r\n13_ON\r\n\r\n')
+        self.assertEqual(dict((pin, s.state) for pin, s in states.items()), {7: RelayState.Off, 13: RelayState.On})
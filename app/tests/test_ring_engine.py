@@ -0,0 +1,135 @@
+from unittest import TestCase, skipIf
+import shutil
+import tempfile
+
+from flask import Flask
+
+from app import rrddb, rrd_writer
+from app.date_util import datetime_from_timestamp
+from app.models import RRDDef
+from app.timeseries import Archive, DataSource, get_backend
+from app.timeseries.ring_engine import RingBackend, np
+
+ARCHIVES = [Archive('AVERAGE', 1, 6), Archive('AVERAGE', 3, 4), Archive('MAX', 3, 4)]
+
+
+@skipIf(np is None, 'numpy is not installed')
+class TestRingEngine(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = self.dir + '/data.rrd'
+        self.backend = RingBackend()
+        self.backend.create(self.path, 10, [DataSource('data', -30, 60)], ARCHIVES, start_ts=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def values(self, cf, resolution, from_ts, to_ts, name='data'):
+        results = self.backend.fetch(self.path, cf, resolution, from_ts, to_ts)
+        return results.from_ts, results.step, [None if v != v else v for v in results.column(name)]
+
+    def update(self, rows):
+        self.backend.update(self.path, ['data'], [(ts, [value]) for ts, value in rows])
+
+    def test_update_and_fetch(self):
+        self.update([(1010, 1.0), (1020, 2.0), (1030, 3.0), (1040, 100.0), (1050, 5.0)])
+
+        self.assertTrue(self.backend.is_initialized(self.path))
+        self.assertEqual(self.backend.last(self.path), (1050, {'data': 5.0}))
+        self.assertEqual(self.values('AVERAGE', 10, 1000, 1050), (1000, 10, [1.0, 2.0, 3.0, None, 5.0]))
+        self.assertEqual(self.values('AVERAGE', 30, 1000, 1050), (990, 30, [1.5, 4.0]))
+        self.assertEqual(self.values('MAX', 30, 1000, 1050), (990, 30, [2.0, 5.0]))
+        self.assertRaises(ValueError, self.update, [(1050, 1.0)])
+
+    def test_ring(self):
+        self.update([(1000 + 10 * i, float(i)) for i in xrange(1, 10)])
+        # rows of one hour ago are overwritten, only last 6 are kept
+        self.assertEqual(self.values('AVERAGE', 10, 1000, 1090)[2], [None, None, None, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0])
+
+        # gap longer than heartbeat is unknown
+        self.update([(1120, 12.0)])
+        self.assertEqual(self.values('AVERAGE', 10, 1060, 1120)[2], [7.0, 8.0, 9.0, None, None, 12.0])
+
+    def test_add_sources(self):
+        self.update([(1010, 1.0), (1020, 2.0)])
+        self.backend.add_sources(self.path, 10, [DataSource('other', 0, 10)], ARCHIVES)
+        self.assertEqual(self.backend.get_sources(self.path), ['data', 'other'])
+
+        self.backend.update(self.path, ['data', 'other'], [(1030, [3.0, 4.0]), (1040, [4.0, 11.0])])
+        self.backend.update(self.path, ['other'], [(1050, [6.0])])
+
+        results = self.backend.fetch(self.path, 'AVERAGE', 10, 1000, 1050)
+        self.assertEqual(results.names, ('data', 'other'))
+        self.assertEqual(self.values('AVERAGE', 10, 1000, 1050), (1000, 10, [1.0, 2.0, 3.0, 4.0, None]))
+        self.assertEqual(self.values('AVERAGE', 10, 1000, 1050, 'other'), (1000, 10, [None, None, 4.0, None, 6.0]))
+        self.assertEqual(self.values('AVERAGE', 30, 1000, 1050, 'other'), (990, 30, [None, 5.0]))
+        self.assertEqual(self.backend.last(self.path), (1050, {'data': 4.0, 'other': 6.0}))
+
+
+@skipIf(np is None, 'numpy is not installed')
+class TestRrddb(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        app = Flask(__name__)
+        app.config.update(TIMESERIES_BACKEND='ring', RRDTOOL_DEFAULT_CFS=['AVERAGE'],
+                          RRDTOOL_DATABASE_RESOLUTIONS=[(1, 1), (5, 2)])
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.rrddefs = [RRDDef(step=60, name=name, mmin=0, mmax=100, path='%s/%s.rrd' % (self.dir, name))
+                        for name in ('a', 'b')]
+
+    def tearDown(self):
+        self.ctx.pop()
+        shutil.rmtree(self.dir)
+
+    def test_copy_into(self):
+        # 1.5 days, older values are kept only by the coarse archive
+        base_ts = 1500000000
+        samples = [(base_ts + 60 * i, float(i % 7)) for i in xrange(1, 36 * 60)]
+        rrddb.add_many(self.rrddefs[0], [(datetime_from_timestamp(ts), v) for ts, v in samples])
+        rrddb.add_many(self.rrddefs[1], [(datetime_from_timestamp(ts), v + 10) for ts, v in samples[:600]])
+
+        path = self.dir + '/sensors.rrd'
+        # a row per step (coarse rows expanded), rows further apart than the heartbeat are unknown for rrdtool
+        self.assertEqual(rrddb.copy_into(self.rrddefs, path, 60), len(samples))
+
+        for rrddef in self.rrddefs:
+            copied = RRDDef(step=60, name=rrddef.name, mmin=0, mmax=100, path=path)
+            for resolution, from_ts, to_ts in [(300, base_ts, base_ts + 3000),
+                                               (60, base_ts + 30 * 3600, base_ts + 31 * 3600)]:
+                expected = rrddb.fetch_range(rrddef, 'AVERAGE', resolution, from_ts, to_ts)
+                results = rrddb.fetch_range(copied, 'AVERAGE', resolution, from_ts, to_ts)
+                self.assertEqual((results.from_ts, results.step), (expected.from_ts, expected.step))
+                self.assertEqual([None if v != v else v for v in results.values],
+                                 [None if v != v else v for v in expected.values])
+
+    def test_write_rows_without_new_source(self):
+        path = self.dir + '/sensors.rrd'
+        sources = [rrddb.get_data_source(rrddef) for rrddef in self.rrddefs]
+        rrddb.write_rows(path, 60, sources[:1], [(datetime_from_timestamp(1500000060), [1.0])])
+
+        def add_sources(*args):
+            raise ValueError('Not supported')
+
+        backend = get_backend('ring')
+        backend.add_sources = add_sources
+        try:
+            skipped = rrddb.write_rows(path, 60, sources, [(datetime_from_timestamp(1500000120), [2.0, 3.0])])
+        finally:
+            del backend.add_sources
+
+        self.assertEqual(skipped, ['b'])
+        self.assertEqual(backend.last(path), (1500000120, {'a': 2.0}))
+
+    def test_writer_skips_rows_written_before_restart(self):
+        rrddef = self.rrddefs[0]
+        rrddb.add_many(rrddef, [(datetime_from_timestamp(1500000060), 1.0)])
+
+        pending = {rrddef.path: rrd_writer._PendingFile(rrddef.path, 60, False)}
+        for ts, value in [(1500000060, 1.0), (1500000120, 2.0)]:
+            pending[rrddef.path].add(rrddef, datetime_from_timestamp(ts), value)
+        errors = rrd_writer.get_stats()['errors']
+        rrd_writer._write(pending, {}, 2, True)
+
+        self.assertEqual(rrd_writer.get_stats()['errors'], errors)
+        self.assertEqual(rrddb.fetch_last(rrddef), (datetime_from_timestamp(1500000120), 2.0))
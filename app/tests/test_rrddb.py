@@ -2,15 +2,14 @@ from unittest import TestCase
 from os import path, makedirs, remove, removedirs
 import datetime as dt
 
+import rrdtool
+
 from app.rrddb import *
 from app.models import RRDDef, Measurement
 
 
 def create_measurement(base_ts, delta_seconds, value):
-    m = Measurement('DATA')
-    m.value = value
-    m.read_ts = base_ts + dt.timedelta(seconds=delta_seconds)
-    return m
+    return Measurement('DATA', value, base_ts + dt.timedelta(seconds=delta_seconds))
 
 
 def insert_values(base_ts, nr, rrddef):
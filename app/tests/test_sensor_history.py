@@ -0,0 +1,84 @@
+from unittest import TestCase, skipIf
+import json
+import logging
+import shutil
+import tempfile
+
+from app import create_app, db, rrddb, sensor_registry
+from app.date_util import datetime_from_timestamp
+from app.models import Sensor, SensorType
+from app.timeseries.ring_engine import np
+
+BASE_TS = 1500000000
+
+
+@skipIf(np is None, 'numpy is not installed')
+class TestSensorHistory(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # extensions can be initialized only once
+        cls.app = create_app('development')
+        cls.app.logger.setLevel(logging.WARNING)
+        cls.app.login_manager._login_disabled = True
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        app = self.app
+        app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///%s/data.sqlite' % (self.dir,), DATABASE_DIR=self.dir,
+                          TIMESERIES_BACKEND='ring', RRDTOOL_DEFAULT_CFS=['AVERAGE', 'MAX'],
+                          RRDTOOL_DATABASE_RESOLUTIONS=[(1, 1), (5, 2)])
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.create_all()
+        sensor_type = SensorType(unit='C', description='Temperature', name='temperature')
+        sensor = Sensor(sensor_code='ABT', description='Air', emit_every=60, min_possible_value=0,
+                        max_possible_value=100, type=sensor_type)
+        db.session.add(sensor)
+        db.session.commit()
+        self.sensor_id = sensor.id
+        sensor_registry.invalidate()
+
+        # 30 hours of values, older than a day only in the coarse archive
+        self.last_ts = BASE_TS + 30 * 60 * 60
+        rrddb.add_many(sensor.get_rrd_definition(), [(datetime_from_timestamp(ts), float(ts / 60 % 50))
+                                                     for ts in xrange(BASE_TS + 60, self.last_ts + 60, 60)])
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        sensor_registry.invalidate()
+        self.ctx.pop()
+        shutil.rmtree(self.dir)
+
+    def get(self, **args):
+        return self.app.test_client().get('/sensors/%d/history.json' % (args.pop('sensor_id', self.sensor_id),),
+                                          query_string=args)
+
+    def test_chunks(self):
+        from_ts, to_ts = self.last_ts - 3 * 60 * 60, self.last_ts
+        expected = [float(ts / 60 % 50) for ts in xrange(from_ts + 60, to_ts + 60, 60)]
+
+        for chunk_rows in [1, 7, 1000]:
+            self.app.config['HISTORY_CHUNK_ROWS'] = chunk_rows
+            response = self.get(**{'from': from_ts, 'to': to_ts, 'resolution': 60})
+            self.assertEqual(response.status_code, 200)
+            series = json.loads(response.data)
+            self.assertEqual((series['from'], series['step'], series['to']), (from_ts, 60, to_ts))
+            self.assertEqual(series['data'], expected)
+
+    def test_range_clamped(self):
+        self.app.config['HISTORY_CHUNK_ROWS'] = 7
+        series = json.loads(self.get(**{'from': 0, 'to': self.last_ts, 'resolution': 300}).data)
+
+        # nothing is written before BASE_TS
+        self.assertEqual(series['from'], BASE_TS)
+        self.assertEqual(series['step'], 300)
+        self.assertEqual(len(series['data']), (self.last_ts - BASE_TS) / 300)
+        self.assertEqual(series['data'][0], sum(float(i % 50) for i in xrange(25000001, 25000006)) / 5)
+
+    def test_errors(self):
+        self.assertEqual(self.get(sensor_id=self.sensor_id + 1).status_code, 404)
+        self.assertEqual(self.get(**{'from': self.last_ts, 'to': self.last_ts - 60}).status_code, 400)
+        self.assertEqual(self.get(cf='MIN').status_code, 400)
+        self.assertEqual(self.get(resolution=-60).status_code, 400)
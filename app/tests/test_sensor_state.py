@@ -0,0 +1,64 @@
+from unittest import TestCase
+import random
+
+from app.dashboard.sensor_state import AlarmWindow
+
+
+class TestAlarmWindow(TestCase):
+    def setUp(self):
+        self.window = AlarmWindow(3, min_limit=10, max_limit=20)
+
+    def tearDown(self):
+        pass
+
+    def test_counts(self):
+        for v in [5, 15, 25, 30]:
+            self.window.append(v)
+
+        self.assertEqual(len(self.window), 3)
+        self.assertTrue(self.window.is_full())
+        self.assertEqual(self.window.nr_low, 0)
+        self.assertEqual(self.window.nr_high, 2)
+        self.assertEqual(self.window.min(), 15)
+        self.assertEqual(self.window.max(), 30)
+
+    def test_resize(self):
+        for v in [5, 1, 25]:
+            self.window.append(v)
+        self.window.resize(1)
+
+        self.assertEqual(len(self.window), 1)
+        self.assertEqual(self.window.nr_low, 0)
+        self.assertEqual(self.window.min(), 25)
+
+    def test_set_limits(self):
+        for i, v in enumerate([5, 15, 25]):
+            self.window.append(v, ts=i)
+        self.window.set_limits(16, 24)
+
+        self.assertEqual(self.window.too_low_items(), [(0, 5), (1, 15)])
+        self.assertEqual(self.window.too_high_items(), [(2, 25)])
+
+    def test_against_rescan(self):
+        window = AlarmWindow(50, min_limit=-5, max_limit=5)
+        values = []
+        # fixed seed, failures can be reproduced
+        rand = random.Random(42)
+        for i in xrange(1000):
+            v = rand.uniform(-10, 10)
+            window.append(v)
+            values = (values + [v])[-50:]
+
+            self.assertEqual(window.min(), min(values))
+            self.assertEqual(window.max(), max(values))
+            self.assertEqual(window.nr_low, len([x for x in values if x < -5]))
+            self.assertEqual(window.nr_high, len([x for x in values if x > 5]))
+
+    def test_unbounded(self):
+        window = AlarmWindow(None)
+        for v in xrange(100):
+            window.append(v, ts=v)
+        window.resize(10)
+
+        self.assertEqual([v for ts, v in window.items()], range(90, 100))
+        self.assertEqual(window.min(), 90)
@@ -1,4 +1,5 @@
 from unittest import TestCase
+from StringIO import StringIO
 
 from app.hardware.serial_monitor import *
 from app.date_util import *
@@ -13,7 +14,7 @@ class TestSerialWatch(TestCase):
 
     def test_get_sensor_value(self):
         llap_stream = StringIO(u'aABT152.123-')
-        base_ts = datetime.datetime.utcnow()
+        base_ts = datetime.utcnow()
         m = get_sensor_value(llap_stream)
 
         self.assertTrue(m is not None)
@@ -21,4 +22,24 @@ class TestSerialWatch(TestCase):
         self.assertEqual(m.device_code, 'AB')
         self.assertEqual(m.measurement_code, 'T')
         self.assertAlmostEqual(m.value, 152.123)
-        self.assertAlmostEqual(timestamp(m.read_ts), timestamp(base_ts))
\ No newline at end of file
+        self.assertAlmostEqual(timestamp(m.read_ts), timestamp(base_ts))
+
+    def test_stream_parser(self):
+        parser = LLAPStreamParser()
+        measurements = parser.feed('--xaABT152.123-aZGB3.2')
+        self.assertEqual(len(measurements), 1)
+        self.assertEqual(measurements[0].sensor_code, 'ABT')
+        self.assertAlmostEqual(measurements[0].value, 152.123)
+
+        measurements = parser.feed('1----aSPT21.5----')
+        self.assertEqual([m.sensor_code for m in measurements], ['ZGB', 'SPT'])
+        self.assertAlmostEqual(measurements[0].value, 3.21)
+        self.assertEqual(len(parser.buffer), 0)
+
+    def test_decode_llap_frames(self):
+        frames = decode_llap_frames(bytearray('xxaZGT-5.20---aZGB1.2-----aSP'), read_ts=100.0)
+        self.assertEqual(frames.sensor_codes, ['ZGT', 'ZGB'])
+        self.assertEqual(list(frames.values), [-5.2, 1.2])
+        self.assertEqual(list(frames.timestamps), [100.0, 100.0])
+        self.assertEqual(frames.consumed, 26)
+        self.assertEqual(frames.skipped_bytes, 2)
@@ -0,0 +1,38 @@
+from unittest import TestCase
+import threading
+
+from flask import Flask
+
+from app import thread_monitor
+
+
+class TestThreadMonitor(TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.config['RESTART_FAILED_THREADS'] = False
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.ctx.pop()
+
+    def wait(self, *args):
+        self.release.wait()
+
+    def test_registry(self):
+        t = thread_monitor.start_thread('Calling 123', False, self.wait, ('123',))
+        thread_monitor.start_thread('Test worker', True, self.wait)
+
+        self.assertTrue(thread_monitor.any_threads_by_name('Calling 123'))
+        self.assertEqual(thread_monitor.get_thread('Calling 123').args, ('123',))
+        self.assertEqual([ti.name for ti in thread_monitor.get_threads_by_prefix('Calling ')], ['Calling 123'])
+        self.assertIsNone(thread_monitor.start_thread('Test worker', True, self.wait))
+        self.assertIn({'name': 'Test worker', 'state': 'running', 'restart_on_exit': True},
+                      [dict((k, v) for k, v in d.items() if k != 'started_ts') for d in thread_monitor.snapshot()])
+
+        self.release.set()
+        t.join()
+        self.assertFalse(thread_monitor.any_threads_by_name('Calling 123'))
+        self.assertIsNone(thread_monitor.get_thread('Calling 123'))
@@ -1,15 +1,135 @@
 import threading
 import Queue
-from time import sleep
+from time import sleep, time
 from collections import namedtuple
 
 from flask import current_app
 
 
 ThreadInfo = namedtuple('ThreadInfo', 'name target args previous_thread')
+TaskInfo = namedtuple('TaskInfo', 'name target args onerror')
 
 threads_for_restart = Queue.Queue()
 
+# threads started by start_thread, by name
+registry_lock = threading.Lock()
+registry = {}
+
+pools_lock = threading.Lock()
+pools = {}
+
+
+class PoolFullException(Exception):
+    pass
+
+
+class RegisteredThread(object):
+    Running = 'running'
+    Finished = 'finished'
+    Failed = 'failed'
+    WaitingForRestart = 'waiting for restart'
+
+    def __init__(self, name, thread, target, args, restart_on_exit):
+        self.name = name
+        self.thread = thread
+        self.target = target
+        self.args = args
+        self.restart_on_exit = restart_on_exit
+        self.started_ts = time()
+        self.state = RegisteredThread.Running
+
+    def is_running(self):
+        return self.state == RegisteredThread.Running
+
+    def to_json_dict(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'started_ts': self.started_ts,
+            'restart_on_exit': self.restart_on_exit
+        }
+
+
+class WorkerPool(object):
+    """ Named queue of tasks executed by a fixed number of long-lived worker threads
+    """
+
+    def __init__(self, name, nr_workers, max_queue_size):
+        self.name = name
+        self.nr_workers = nr_workers
+        self.queue = Queue.Queue(maxsize=max_queue_size)
+
+    def start(self):
+        for i in range(self.nr_workers):
+            start_thread('Worker %s %d' % (self.name, i + 1),
+                         restart_on_exit=True,
+                         target=_work,
+                         args=(self.queue, current_app._get_current_object()))
+
+    def submit(self, task, timeout):
+        try:
+            # blocks the caller while the queue is full (backpressure)
+            self.queue.put(task, timeout=timeout)
+        except Queue.Full:
+            raise PoolFullException('Worker pool %s is full, task %s rejected' % (self.name, task.name))
+
+
+def get_pool(pool_name):
+    with pools_lock:
+        pool = pools.get(pool_name)
+        if pool is None:
+            nr_workers, max_queue_size = current_app.config['THREAD_POOLS'][pool_name]
+            pool = pools[pool_name] = WorkerPool(pool_name, nr_workers, max_queue_size)
+            pool.start()
+    return pool
+
+
+def submit(pool_name, name, target, args=(), onerror=None):
+    """ Executes target in one of the workers of the pool (see config option THREAD_POOLS)
+    """
+    current_app.logger.log(2, 'Submitting task %s to %s' % (name, pool_name))
+    task = TaskInfo(name, target, args, onerror)
+    try:
+        get_pool(pool_name).submit(task, current_app.config['THREAD_POOL_SUBMIT_TIMEOUT'])
+    except PoolFullException as e:
+        if onerror is None:
+            current_app.logger.exception(e)
+        else:
+            onerror(e, *args)
+
+
+def get_stats():
+    """ Returns number of running threads and per pool workers and queued tasks
+    """
+    with pools_lock:
+        pool_stats = dict((name, {'workers': pool.nr_workers, 'queue_depth': pool.queue.qsize()})
+                          for name, pool in pools.items())
+    return {
+        'threads': threading.active_count(),
+        'registered_threads': len(registry),
+        'restart_queue_depth': threads_for_restart.qsize(),
+        'pools': pool_stats
+    }
+
+
+def _work(queue, app):
+    while True:
+        task = queue.get()
+        try:
+            # every task gets its own context (and db session), same as a thread would
+            with app.app_context():
+                current_app.logger.log(2, 'Task %s started' % task.name)
+                try:
+                    task.target(*task.args)
+                except Exception as e:
+                    if task.onerror is None:
+                        current_app.logger.info('Exception in task ' + task.name)
+                        current_app.logger.exception(e)
+                    else:
+                        task.onerror(e, *task.args)
+        finally:
+            queue.task_done()
+
 
 def start_monitor():
     start_thread('Thread monitor',
@@ -31,41 +151,62 @@ def _monitor(app):
 
 
 def any_threads_by_name(name):
-    return any(t.name == name for t in threading.enumerate())
+    with registry_lock:
+        rt = registry.get(name)
+        return rt is not None and rt.is_running()
 
 
 def get_thread(name):
-    thread = next(t for t in threading.enumerate() if t.name == name)
-    if thread is not None:
-        return ThreadInfo(thread.name, None, thread._Thread__args[4], None)
+    """ Returns ThreadInfo of the running thread started with start_thread or None
+    """
+    with registry_lock:
+        rt = registry.get(name)
+        if rt is not None and rt.is_running():
+            return ThreadInfo(rt.name, rt.target, rt.args, None)
     return None
 
-# Threads with "restart_on_exit" enabled will be restarted if failed.
-def start_thread(name, restart_on_exit, target, args=(), onerror=None):
-    # allow only one thread of same name (enumerate returns only alive ones)
 
-    if restart_on_exit:
-        for t in threading.enumerate():
-            if t.name == name:
-                current_app.logger.info('Can not start thread, already running %s' % name)
-                return
+def get_threads_by_prefix(prefix):
+    with registry_lock:
+        return [ThreadInfo(rt.name, rt.target, rt.args, None)
+                for rt in registry.itervalues() if rt.is_running() and rt.name.startswith(prefix)]
+
 
+def snapshot():
+    """ Returns state of all threads started with start_thread, sorted by name
+    """
+    with registry_lock:
+        return [rt.to_json_dict() for name, rt in sorted(registry.items())]
+
+
+# Threads with "restart_on_exit" enabled will be restarted if failed.
+def start_thread(name, restart_on_exit, target, args=(), onerror=None):
     current_app.logger.log(2, 'Starting thread %s' % name)
     t = threading.Thread(name=name,
                          target=_start_thread,
                          args=(name, restart_on_exit, target,
                                current_app._get_current_object(), args, onerror))
     t.setDaemon(True)
+
+    with registry_lock:
+        # allow only one thread of same name
+        if restart_on_exit and name in registry and registry[name].is_running():
+            current_app.logger.info('Can not start thread, already running %s' % name)
+            return
+        registry[name] = RegisteredThread(name, t, target, args, restart_on_exit)
+
     t.start()
     return t
 
 
 def _start_thread(name, restart, target, app, args, onerror):
+    state = RegisteredThread.Finished
     with app.app_context():
         current_app.logger.log(2, 'Thread %s started' % name)
         try:
             target(*args)
         except Exception as e:
+            state = RegisteredThread.Failed
             if onerror is None:
                 current_app.logger.info('Exception in thread ' + name)
                 current_app.logger.exception(e)
@@ -75,6 +216,25 @@ def _start_thread(name, restart, target, app, args, onerror):
             if restart:
                 if current_app.config['RESTART_FAILED_THREADS']:
                     current_app.logger.info('Put thread in queue for restart')
+                    _set_state(name, RegisteredThread.WaitingForRestart)
                     threads_for_restart.put(ThreadInfo(name, target, args, threading.current_thread))
                 else:
                     current_app.logger.info('Wont put thread for restart. Check config option RESTART_FAILED_THREADS')
+                    _set_state(name, state)
+            else:
+                _unregister(name)
+
+
+def _set_state(name, state):
+    with registry_lock:
+        rt = registry.get(name)
+        if rt is not None and rt.thread is threading.current_thread():
+            rt.state = state
+
+
+def _unregister(name):
+    with registry_lock:
+        rt = registry.get(name)
+        # a newer thread of the same name may be registered already
+        if rt is not None and rt.thread is threading.current_thread():
+            del registry[name]
@@ -0,0 +1,98 @@
+"""
+    Storage engines for sensor time series. A database file holds one or more data sources (sensors) sharing
+    the step and archives, rows are written for all data sources at once.
+
+    rrddb is the interface used by the rest of the application, it picks the engine configured with
+    TIMESERIES_BACKEND:
+    rrdtool - round robin databases of rrdtool (every call opens and parses the file)
+    ring - memory mapped ring files (see ring_engine), kept open, read as numpy views
+"""
+from collections import namedtuple
+from threading import Lock
+
+# consolidation function, number of primary (step long) values in a row, number of rows
+Archive = namedtuple('Archive', 'cf pdp_per_row rows')
+# values out of [mmin, mmax] are stored as unknown
+DataSource = namedtuple('DataSource', 'name mmin mmax')
+
+BACKENDS = {
+    'rrdtool': ('rrdtool_engine', 'RrdtoolBackend'),
+    'ring': ('ring_engine', 'RingBackend')
+}
+
+_lock = Lock()
+_backends = {}
+
+
+class Backend(object):
+    """ Storage engine interface, timestamps are seconds since epoch, unknown values are NaN
+    """
+
+    def is_initialized(self, path):
+        raise NotImplementedError()
+
+    def create(self, path, step, sources, archives, start_ts=None):
+        """ Creates the database (if it does not exist), rows not newer than start_ts are not accepted
+        """
+        raise NotImplementedError()
+
+    def get_sources(self, path):
+        """ Returns names of data sources in the file
+        """
+        raise NotImplementedError()
+
+    def add_sources(self, path, step, sources, archives):
+        """ Adds data sources (unknown values for the past) to an existing file
+        """
+        raise NotImplementedError()
+
+    def can_add_sources(self):
+        """ Returns False when the engine cannot add data sources to an existing file
+        """
+        return True
+
+    def update(self, path, names, rows):
+        """ Writes (timestamp, values) rows ordered by time, values of the named data sources in the same order,
+        rows must be newer than the last update
+        """
+        raise NotImplementedError()
+
+    def last(self, path):
+        """ Returns (timestamp of the last update, {data source name: last value})
+        """
+        raise NotImplementedError()
+
+    def fetch(self, path, cf, resolution, from_ts, to_ts):
+        """ Returns RrdFetchResults (column per data source) of the archive with the given consolidation function
+        and resolution (seconds) closest to the requested one
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        """ Makes written data durable
+        """
+        pass
+
+
+def format_data_source(step, source):
+    return 'DS:{name:s}:GAUGE:{missed:d}:{mmin:f}:{mmax:f}'.format(name=source.name, missed=step * 2,
+                                                                   mmin=source.mmin, mmax=source.mmax)
+
+
+def format_definition(step, sources, archives):
+    """ rrdtool create arguments (data sources and archives), one per line
+    """
+    return '\n'.join([format_data_source(step, s) for s in sources] +
+                     ['RRA:{cf:s}:0.5:{pdp_per_row:d}:{rows:d}'.format(**a._asdict()) for a in archives])
+
+
+def get_backend(name):
+    with _lock:
+        backend = _backends.get(name)
+        if backend is None:
+            if name not in BACKENDS:
+                raise ValueError('Unknown time series backend %s' % (name,))
+            module_name, class_name = BACKENDS[name]
+            module = __import__(module_name, globals(), level=1)
+            backend = _backends[name] = getattr(module, class_name)()
+    return backend
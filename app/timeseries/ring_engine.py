@@ -0,0 +1,322 @@
+"""
+    Time series in memory mapped ring files.
+
+    A file holds a header, a table of data sources, a table of archives and, for every archive, the
+    consolidation state and a fixed number of float64 rows (a value per data source) used as a ring: row of
+    the bucket (timestamp + resolution - 1) // resolution is at bucket % rows. Every row written is consolidated
+    into all archives at once (AVERAGE, MIN, MAX or LAST of the values in the bucket, per data source), buckets
+    without values are unknown (NaN), unless the gap to the previous update is within the heartbeat (two
+    steps), then they take the new value (as rrdtool does for GAUGE data sources).
+
+    Files are mapped once and kept open, fetched columns are read-only numpy views of the mapped rows
+    whenever the requested range is stored contiguously (a copy otherwise).
+"""
+import os
+from os.path import isfile, splitext
+from threading import Lock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import Archive, Backend, DataSource
+from ..models import RrdFetchResults
+
+MAGIC = 'FCRING02'
+
+CFS = ['AVERAGE', 'MIN', 'MAX', 'LAST']
+
+if np is not None:
+    HEADER_DTYPE = np.dtype([('magic', 'S8'), ('step', '<i8'), ('nr_sources', '<i8'), ('nr_archives', '<i8'),
+                             ('last_update', '<i8'), ('reserved', '<i8', 3)])
+    SOURCE_DTYPE = np.dtype([('name', 'S24'), ('mmin', '<f8'), ('mmax', '<f8'), ('last_value', '<f8')])
+    # bucket is the bucket currently consolidated, its state (count and value per data source) is at offset,
+    # followed by the rows
+    ARCHIVE_DTYPE = np.dtype([('cf', '<i8'), ('pdp_per_row', '<i8'), ('rows', '<i8'), ('offset', '<i8'),
+                              ('bucket', '<i8'), ('reserved', '<i8', 3)])
+
+NAN = float('nan')
+
+
+def get_path(path):
+    return splitext(path)[0] + '.ring'
+
+
+def _bucket(ts, resolution):
+    return (ts + resolution - 1) // resolution
+
+
+def _archive_size(archive, nr_sources):
+    return 8 * nr_sources * (2 + archive.rows)
+
+
+class RingFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.mm = np.memmap(path, dtype=np.uint8, mode='r+')
+        self.header = self.mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+        if self.header['magic'][0] != MAGIC:
+            raise ValueError('%s is not a ring file' % (path,))
+
+        nr_sources = int(self.header['nr_sources'][0])
+        sources_end = HEADER_DTYPE.itemsize + SOURCE_DTYPE.itemsize * nr_sources
+        self.sources = self.mm[HEADER_DTYPE.itemsize:sources_end].view(SOURCE_DTYPE)
+        self.names = [str(name) for name in self.sources['name']]
+        self.source_index = dict((name, i) for i, name in enumerate(self.names))
+
+        archives_end = sources_end + ARCHIVE_DTYPE.itemsize * int(self.header['nr_archives'][0])
+        self.archives = self.mm[sources_end:archives_end].view(ARCHIVE_DTYPE)
+        # (counts, values, rows x data sources) of every archive
+        self.data = []
+        for a in self.archives:
+            state = self.mm[a['offset']:a['offset'] + 16 * nr_sources]
+            rows = self.mm[a['offset'] + 16 * nr_sources:a['offset'] + 8 * nr_sources * (2 + a['rows'])]
+            self.data.append((state[:8 * nr_sources].view('<i8'), state[8 * nr_sources:].view('<f8'),
+                              rows.view('<f8').reshape(int(a['rows']), nr_sources)))
+
+    @staticmethod
+    def create(path, step, sources, archives, start_ts):
+        data_offset = HEADER_DTYPE.itemsize + SOURCE_DTYPE.itemsize * len(sources) + \
+            ARCHIVE_DTYPE.itemsize * len(archives)
+        size = data_offset + sum(_archive_size(a, len(sources)) for a in archives)
+
+        mm = np.memmap(path, dtype=np.uint8, mode='w+', shape=(size,))
+        header = mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+        header[0] = (MAGIC, step, len(sources), len(archives), start_ts or 0, 0)
+
+        sources_end = HEADER_DTYPE.itemsize + SOURCE_DTYPE.itemsize * len(sources)
+        table = mm[HEADER_DTYPE.itemsize:sources_end].view(SOURCE_DTYPE)
+        for i, s in enumerate(sources):
+            table[i] = (s.name, NAN if s.mmin is None else s.mmin, NAN if s.mmax is None else s.mmax, NAN)
+
+        table = mm[sources_end:data_offset].view(ARCHIVE_DTYPE)
+        offset = data_offset
+        for i, a in enumerate(archives):
+            table[i] = (CFS.index(a.cf), a.pdp_per_row, a.rows, offset, 0, 0)
+            # counts are zero, values and rows unknown
+            mm[offset + 8 * len(sources):offset + _archive_size(a, len(sources))].view('<f8')[:] = NAN
+            offset += _archive_size(a, len(sources))
+
+        mm.flush()
+        del mm
+
+    def get_definition(self):
+        """ Returns (step, data sources, archives) of the file
+        """
+        sources = [DataSource(str(s['name']), float(s['mmin']), float(s['mmax'])) for s in self.sources]
+        archives = [Archive(CFS[int(a['cf'])], int(a['pdp_per_row']), int(a['rows'])) for a in self.archives]
+        return int(self.header['step'][0]), sources, archives
+
+    def copy_to(self, other):
+        """ Copies state and rows of all data sources into a file with (at least) the same data sources
+        and archives
+        """
+        indexes = [other.source_index[name] for name in self.names]
+        for (counts, values, rows), (other_counts, other_values, other_rows) in zip(self.data, other.data):
+            other_counts[indexes] = counts
+            other_values[indexes] = values
+            other_rows[:, indexes] = rows
+        other.archives['bucket'] = self.archives['bucket']
+        other.sources['last_value'][indexes] = self.sources['last_value']
+        other.header['last_update'] = self.header['last_update']
+
+    def update(self, names, rows):
+        if len(rows) == 0:
+            return
+        try:
+            indexes = [self.source_index[name] for name in names]
+        except KeyError as e:
+            raise ValueError('Unknown data source %s in %s' % (e.args[0], self.path))
+
+        step = int(self.header['step'][0])
+        last_update = int(self.header['last_update'][0])
+
+        if rows[0][0] <= last_update:
+            raise ValueError('Illegal attempt to update %s using time %d when last update time is %d'
+                             % (self.path, rows[0][0], last_update))
+
+        ts = np.array([row[0] for row in rows], dtype=np.int64)
+        values = np.empty((len(rows), len(self.names)), dtype=np.float64)
+        values[:] = NAN
+        values[:, indexes] = [row[1] for row in rows]
+        with np.errstate(invalid='ignore'):
+            values[(values < self.sources['mmin']) | (values > self.sources['mmax'])] = NAN
+        known = ~np.isnan(values)
+
+        previous_ts = np.concatenate(([last_update], ts[:-1]))
+        within_heartbeat = (previous_ts > 0) & (ts - previous_ts <= 2 * step)
+
+        # all rows are consolidated at once, per archive
+        for a, (counts, acc_values, data) in zip(self.archives, self.data):
+            cf = int(a['cf'])
+            resolution = step * int(a['pdp_per_row'])
+            nr_rows = int(a['rows'])
+            bucket = int(a['bucket'])
+
+            buckets = (ts + resolution - 1) // resolution
+            starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+            group_buckets = buckets[starts]
+            group_counts = np.add.reduceat(known.astype(np.int64), starts, axis=0)
+            # the first group continues the bucket in progress
+            continued = group_buckets[0] == bucket
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                if cf == 0:
+                    sums = np.add.reduceat(np.where(known, values, 0.0), starts, axis=0)
+                    if continued:
+                        sums[0] += np.where(counts > 0, acc_values * counts, 0.0)
+                        group_counts[0] += counts
+                    consolidated = np.where(group_counts > 0, sums / group_counts, NAN)
+                elif cf == 3:
+                    positions = np.where(known, np.arange(len(rows))[:, np.newaxis], -1)
+                    last_positions = np.maximum.reduceat(positions, starts, axis=0)
+                    consolidated = np.where(last_positions >= 0,
+                                            values[last_positions, np.arange(len(self.names))], NAN)
+                    if continued:
+                        consolidated[0] = np.where(group_counts[0] > 0, consolidated[0], acc_values)
+                        group_counts[0] += counts
+                else:
+                    reduce_values = np.fmin if cf == 1 else np.fmax
+                    consolidated = reduce_values.reduceat(values, starts, axis=0)
+                    if continued:
+                        consolidated[0] = reduce_values(consolidated[0], acc_values)
+                        group_counts[0] += counts
+
+            # buckets skipped between updates take the next value within the heartbeat, only the buckets
+            # still in the ring are written
+            lowest = group_buckets[-1] - nr_rows + 1
+            previous_buckets = np.concatenate(([bucket], group_buckets[:-1]))
+            if bucket > 0:
+                for g in np.flatnonzero(group_buckets - previous_buckets > 1):
+                    skipped = np.arange(max(previous_buckets[g] + 1, lowest), group_buckets[g])
+                    if len(skipped) > 0:
+                        data[skipped % nr_rows] = values[starts[g]] if within_heartbeat[starts[g]] else NAN
+            kept = group_buckets >= lowest
+            data[group_buckets[kept] % nr_rows] = consolidated[kept]
+
+            a['bucket'] = group_buckets[-1]
+            counts[:] = group_counts[-1]
+            acc_values[:] = consolidated[-1]
+
+        self.header['last_update'] = ts[-1]
+        self.sources['last_value'][indexes] = values[-1, indexes]
+
+    def last(self):
+        return int(self.header['last_update'][0]), dict(zip(self.names, self.sources['last_value'].tolist()))
+
+    def select_archive(self, cf, resolution):
+        """ Index of the archive with the closest resolution (coarser preferred) for the consolidation function
+        """
+        step = int(self.header['step'][0])
+        candidates = [(int(a['pdp_per_row']) * step, i) for i, a in enumerate(self.archives)
+                      if CFS[int(a['cf'])] == cf]
+        if len(candidates) == 0:
+            raise ValueError('No %s archive in %s' % (cf, self.path))
+
+        coarser = [c for c in candidates if c[0] >= resolution]
+        return min(coarser)[1] if len(coarser) > 0 else max(candidates)[1]
+
+    def fetch(self, cf, resolution, from_ts, to_ts):
+        i = self.select_archive(cf, resolution)
+        archive = self.archives[i]
+        data = self.data[i][2]
+        resolution = int(archive['pdp_per_row']) * int(self.header['step'][0])
+        rows = int(archive['rows'])
+
+        from_ts = int(from_ts) // resolution * resolution
+        to_ts = _bucket(int(to_ts), resolution) * resolution
+        nr_rows = (to_ts - from_ts) // resolution
+
+        # row i holds the bucket ending at from_ts + (i + 1) * resolution
+        first = from_ts // resolution + 1
+        last_bucket = int(archive['bucket'])
+        lo = max(first, last_bucket - rows + 1)
+        hi = min(first + nr_rows - 1, last_bucket)
+
+        if last_bucket > 0 and lo == first and hi == first + nr_rows - 1 and lo % rows <= hi % rows:
+            block = data[lo % rows:hi % rows + 1]
+            block.flags.writeable = False
+        else:
+            block = np.empty((nr_rows, len(self.names)), dtype=np.float64)
+            block[:] = NAN
+            if last_bucket > 0 and lo <= hi:
+                block[lo - first:hi - first + 1] = data[np.arange(lo, hi + 1) % rows]
+
+        return RrdFetchResults.from_columns(self.names, from_ts, resolution,
+                                            [block[:, j] for j in xrange(len(self.names))])
+
+    def flush(self):
+        self.mm.flush()
+
+
+class RingBackend(Backend):
+    def __init__(self):
+        if np is None:
+            raise ImportError('Ring file time series backend requires numpy')
+        self._lock = Lock()
+        self._files = {}
+
+    def _get(self, path):
+        path = get_path(path)
+        with self._lock:
+            ring_file = self._files.get(path)
+            if ring_file is None:
+                ring_file = self._files[path] = RingFile(path)
+        return ring_file
+
+    def is_initialized(self, path):
+        return isfile(get_path(path))
+
+    def create(self, path, step, sources, archives, start_ts=None):
+        path = get_path(path)
+        with self._lock:
+            if not isfile(path):
+                RingFile.create(path, step, sources, archives, start_ts)
+
+    def get_sources(self, path):
+        return list(self._get(path).names)
+
+    def add_sources(self, path, step, sources, archives):
+        """ Rewrites the file with the new data sources appended (existing ones keep their limits)
+        """
+        ring_file = self._get(path)
+        with ring_file.lock:
+            step, old_sources, archives = ring_file.get_definition()
+            new_sources = [s for s in sources if s.name not in ring_file.source_index]
+            if len(new_sources) == 0:
+                return
+
+            tmp_path = ring_file.path + '.tmp'
+            RingFile.create(tmp_path, step, old_sources + new_sources, archives, None)
+            new_file = RingFile(tmp_path)
+            ring_file.copy_to(new_file)
+            new_file.flush()
+            ring_file.flush()
+            # columns fetched before keep the old mapping
+            os.rename(tmp_path, ring_file.path)
+
+            with self._lock:
+                self._files[ring_file.path] = RingFile(ring_file.path)
+
+    def update(self, path, names, rows):
+        while True:
+            ring_file = self._get(path)
+            with ring_file.lock:
+                # the file might have been replaced (add_sources) while waiting for the lock
+                if self._files.get(ring_file.path) is ring_file:
+                    ring_file.update(names, rows)
+                    return
+
+    def last(self, path):
+        return self._get(path).last()
+
+    def fetch(self, path, cf, resolution, from_ts, to_ts):
+        return self._get(path).fetch(cf, resolution, from_ts, to_ts)
+
+    def flush(self):
+        with self._lock:
+            files = self._files.values()
+        for ring_file in files:
+            ring_file.flush()
@@ -0,0 +1,71 @@
+from os.path import isfile
+import re
+import shutil
+import tempfile
+
+import rrdtool
+
+from . import Archive, Backend, DataSource, format_definition, format_data_source
+from ..models import RrdFetchResults
+
+_ds_index = re.compile(r'^ds\[(.+)\]\.index$')
+
+
+def _format_value(value):
+    return 'U' if value is None or value != value else '{:f}'.format(value)
+
+
+class RrdtoolBackend(Backend):
+    _can_add_sources = None
+
+    def is_initialized(self, path):
+        return isfile(path)
+
+    def create(self, path, step, sources, archives, start_ts=None):
+        rrd_args = filter(len, format_definition(step, sources, archives).split('\n'))
+        if start_ts is not None:
+            rrd_args = ['--start', str(start_ts)] + rrd_args
+
+        rrdtool.create(path, '--step', str(step), '--no-overwrite', *rrd_args)
+
+    def get_sources(self, path):
+        info = rrdtool.info(path)
+        indexes = [(index, _ds_index.match(key).group(1)) for key, index in info.iteritems()
+                   if _ds_index.match(key)]
+        return [name for index, name in sorted(indexes)]
+
+    def add_sources(self, path, step, sources, archives):
+        # requires rrdtool 1.5+
+        rrdtool.tune(path, *[format_data_source(step, s) for s in sources])
+
+    def can_add_sources(self):
+        if self._can_add_sources is None:
+            # the python binding does not tell the library version, try it on a scratch file
+            temp_dir = tempfile.mkdtemp()
+            try:
+                path = temp_dir + '/probe.rrd'
+                self.create(path, 60, [DataSource('a', 0, 1)], [Archive('AVERAGE', 1, 10)])
+                self.add_sources(path, 60, [DataSource('b', 0, 1)], [])
+                RrdtoolBackend._can_add_sources = self.get_sources(path) == ['a', 'b']
+            except rrdtool.error:
+                RrdtoolBackend._can_add_sources = False
+            finally:
+                shutil.rmtree(temp_dir)
+        return self._can_add_sources
+
+    def update(self, path, names, rows):
+        rrdtool.update(path, '--template', ':'.join(names),
+                       *['%d:%s' % (ts, ':'.join(_format_value(v) for v in values)) for ts, values in rows])
+
+    def last(self, path):
+        info = rrdtool.info(path)
+        last_values = {}
+        for name in self.get_sources(path):
+            try:
+                last_values[name] = float(info['ds[%s].last_ds' % (name,)])
+            except (KeyError, TypeError, ValueError):
+                last_values[name] = float('nan')
+        return int(info['last_update']), last_values
+
+    def fetch(self, path, cf, resolution, from_ts, to_ts):
+        return RrdFetchResults(rrdtool.fetch(path, cf, '-r', str(resolution), '-s', str(from_ts), '-e', str(to_ts)))
@@ -0,0 +1,58 @@
+"""
+    Microbenchmark of LLAP decoding: byte by byte get_sensor_value (previous listen_real path) against
+    decode_llap_frames over one received chunk.
+
+    Run from project root: python -m benchmarks.llap_decoder [number of frames]
+"""
+import sys
+import random
+from io import BytesIO
+from time import time
+
+from app.hardware.serial_monitor import get_sensor_value, decode_llap_frames, to_measurements, LLAP_FRAME_LENGTH
+
+
+def generate_frames(nr_frames):
+    frames = []
+    for i in xrange(nr_frames):
+        frame = 'a{}{:.2f}'.format(random.choice(['ZGT', 'ZGH', 'ZGB', 'SPT', 'SPH', 'SPB']),
+                                   random.uniform(-10, 100))
+        frames.append(frame + '-' * (LLAP_FRAME_LENGTH - len(frame)))
+    return ''.join(frames)
+
+
+def bench_get_sensor_value(data):
+    stream = BytesIO(data)
+    measurements = []
+    while stream.tell() < len(data):
+        m = get_sensor_value(stream)
+        if m is not None:
+            measurements.append(m)
+    return len(measurements)
+
+
+def bench_decode(data):
+    return len(decode_llap_frames(bytearray(data)).values)
+
+
+def bench_decode_to_measurements(data):
+    return len(to_measurements(decode_llap_frames(bytearray(data))))
+
+
+def run(nr_frames=100000, repeat=3):
+    data = generate_frames(nr_frames)
+    print 'Decoding %d LLAP frames (%d bytes), best of %d' % (nr_frames, len(data), repeat)
+    for name, fn in [('get_sensor_value', bench_get_sensor_value),
+                     ('decode_llap_frames', bench_decode),
+                     ('decode_llap_frames + to_measurements', bench_decode_to_measurements)]:
+        best = None
+        for i in xrange(repeat):
+            start = time()
+            decoded = fn(data)
+            elapsed = time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print '{:40s} {:8.3f} s  {:12.0f} frames/s  ({:d} decoded)'.format(name, best, nr_frames / best, decoded)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,164 @@
+"""
+    End-to-end benchmark of controller.process_measurement (sensor lookup, RRD write, sensor state,
+    notifications, socket.io emit) with many simulated sensors fed from a single generator.
+
+    Uses the development config with a temporary DATABASE_DIR and a socket.io stub that only counts messages.
+    Samples are fed in chunks (like serial_monitor gets them from the radio), the generator yields to other
+    threads (greenlets) between chunks.
+
+    Run from project root: python -m benchmarks.pipeline --sensors 2000 --rate 1000 --duration 30
+    (--rate 0 feeds samples as fast as possible)
+"""
+from gevent import monkey
+
+# same as manage.py, threads are greenlets
+monkey.patch_all()
+
+import os
+import sys
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+from time import time, sleep
+
+DATABASE_DIR = tempfile.mkdtemp(prefix='farmcontrol-bench-')
+os.environ['DEV_DATABASE_DIR'] = DATABASE_DIR + '/'
+
+from app import create_app, db, socketio, rrd_writer
+from app.models import Sensor, SensorType, Device, Measurement
+from app import date_util
+
+
+class StubSocketIO(object):
+    def __init__(self):
+        self.messages = {}
+
+    def emit(self, event, *args, **kwargs):
+        self.messages[event] = self.messages.get(event, 0) + 1
+
+
+def create_sensors(nr_sensors, emit_every):
+    st = SensorType(unit=u'C', description=u'Temperature', name='temperature')
+    device = Device(description='Benchmark')
+    db.session.add(st)
+    db.session.add(device)
+    codes = []
+    for i in xrange(nr_sensors):
+        # 3 char sensor codes: 2 char device id + measurement type
+        code = '%s%s%s' % (chr(65 + i // 676 % 26), chr(65 + i // 26 % 26), chr(65 + i % 26))
+        db.session.add(Sensor(sensor_code=code, description='Sensor %s' % code,
+                              max_possible_value=60, max_warning_value=40,
+                              min_possible_value=-20, min_warning_value=0,
+                              observable_measurements=3, observable_alarming_measurements=2,
+                              enable_warnings=True, device=device, type=st,
+                              emit_every=emit_every))
+        codes.append(code)
+    db.session.commit()
+    return codes
+
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+def run(nr_sensors, rate, duration, chunk, alarm_ratio, emit_every, save_to_rrd):
+    from app.dashboard import controller, emit_batcher
+
+    codes = create_sensors(nr_sensors, emit_every)
+    if not save_to_rrd:
+        Sensor.query.update({Sensor.save_to_rrd_db: False})
+        db.session.commit()
+
+    rrd_writer.start()
+    emit_batcher.start()
+
+    latencies = []
+    interval = float(chunk) / rate if rate > 0 else 0
+    started = time()
+    next_at = started
+    i = 0
+    while time() - started < duration:
+        # let the writer and batcher threads run, same as a blocking serial read would
+        sleep(max(0, next_at - time()))
+        next_at += interval
+
+        read_ts = date_util.datetime_now()
+        for _ in xrange(chunk):
+            if random.random() < alarm_ratio:
+                value = random.uniform(41, 60)
+            else:
+                value = random.uniform(1, 39)
+            measurement = Measurement(codes[i % len(codes)], round(value, 2), read_ts)
+            i += 1
+
+            t = time()
+            controller.process_measurement(measurement)
+            latencies.append(time() - t)
+
+    elapsed = time() - started
+    flush_started = time()
+    rrd_writer.flush()
+    flush_elapsed = time() - flush_started
+
+    latencies.sort()
+    return {
+        'samples': len(latencies),
+        'elapsed': elapsed,
+        'samples_per_second': len(latencies) / elapsed,
+        'busy_samples_per_second': len(latencies) / sum(latencies) if sum(latencies) > 0 else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        'rrd_flush_s': flush_elapsed,
+        'rrd_writer': rrd_writer.get_stats(),
+        'emit_batcher': emit_batcher.get_stats()
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Measurement pipeline benchmark')
+    parser.add_argument('--sensors', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=0, help='samples per second (0 = as fast as possible)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--chunk', type=int, default=20, help='samples fed between yields to other threads')
+    parser.add_argument('--alarm-ratio', type=float, default=0.01, help='share of samples out of limits')
+    parser.add_argument('--emit-every', type=int, default=5, help='sensor step in seconds')
+    parser.add_argument('--no-rrd', action='store_true', help='do not write RRD databases')
+    parser.add_argument('--backend', default=None, help='time series backend (see TIMESERIES_BACKEND)')
+    parser.add_argument('--group', action='store_true', help='one database per step (see RRDTOOL_GROUP_SENSORS)')
+    args = parser.parse_args(argv)
+
+    app = create_app('development')
+    app.config.update(SEND_SMS=False, MAKE_CALLS=False, MAIL_SUPPRESS_SEND=True)
+    if args.backend is not None:
+        app.config['TIMESERIES_BACKEND'] = args.backend
+    app.config['RRDTOOL_GROUP_SENSORS'] = args.group
+    app.logger.setLevel(logging.WARNING)
+
+    stub = StubSocketIO()
+    socketio.emit = stub.emit
+
+    try:
+        with app.app_context():
+            db.create_all()
+            result = run(args.sensors, args.rate, args.duration, args.chunk, args.alarm_ratio,
+                         args.emit_every, not args.no_rrd)
+    finally:
+        shutil.rmtree(DATABASE_DIR, ignore_errors=True)
+
+    print 'Sensors: %d, target rate: %s samples/s' % (args.sensors, args.rate or 'max')
+    print 'Samples: %(samples)d in %(elapsed).1f s, %(samples_per_second).0f samples/s ' \
+          '(%(busy_samples_per_second).0f samples/s of pipeline time)' % result
+    print 'Latency per sample: p50 %(p50_ms).3f ms, p99 %(p99_ms).3f ms, max %(max_ms).3f ms' % result
+    print 'RRD flush on shutdown: %(rrd_flush_s).2f s' % result
+    print 'RRD writer:', result['rrd_writer']
+    print 'Emit batcher:', result['emit_batcher']
+    print 'Socket.io messages:', stub.messages
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+"""
+    Time series storage engines side by side: batched updates, full history fetches and last value reads
+    of many series, archives as in the production config (RRDTOOL_DATABASE_RESOLUTIONS). Series are stored
+    in a database each and then all in one database (as with RRDTOOL_GROUP_SENSORS).
+
+    Run from project root: python -m benchmarks.timeseries [number of series] [samples per series]
+"""
+import sys
+import shutil
+import tempfile
+from time import time
+
+from config import ProductionConfig
+from app.timeseries import Archive, DataSource, BACKENDS, get_backend
+
+STEP = 10
+BATCH_SIZE = 50
+
+
+def get_archives(step):
+    return [Archive(cf, values_to_summarize, (days_to_keep * 24 * 60 * 60) / (step * values_to_summarize))
+            for values_to_summarize, days_to_keep in ProductionConfig.RRDTOOL_DATABASE_RESOLUTIONS
+            for cf in ProductionConfig.RRDTOOL_DEFAULT_CFS]
+
+
+def run(backend, directory, nr_series, nr_samples, grouped):
+    start_ts = int(time()) - nr_samples * STEP
+    sources = [DataSource('S%02d' % i, -30, 60) for i in xrange(nr_series)]
+    if grouped:
+        files = [('%s/sensors.rrd' % (directory,), sources)]
+    else:
+        files = [('%s/s%d.rrd' % (directory, i), [s]) for i, s in enumerate(sources)]
+    archives = get_archives(STEP)
+
+    t = time()
+    for path, file_sources in files:
+        backend.create(path, STEP, file_sources, archives, start_ts)
+    create_s = time() - t
+
+    t = time()
+    for offset in xrange(0, nr_samples, BATCH_SIZE):
+        for path, file_sources in files:
+            backend.update(path, [s.name for s in file_sources],
+                           [(start_ts + (i + 1) * STEP, [float(i % 50)] * len(file_sources))
+                            for i in xrange(offset, min(offset + BATCH_SIZE, nr_samples))])
+    backend.flush()
+    update_s = time() - t
+
+    t = time()
+    for path, file_sources in files:
+        backend.fetch(path, 'AVERAGE', STEP, start_ts, start_ts + nr_samples * STEP)
+    fetch_s = time() - t
+
+    t = time()
+    for path, file_sources in files:
+        backend.last(path)
+    last_s = time() - t
+
+    return create_s, update_s, fetch_s, last_s
+
+
+def main(argv):
+    nr_series = int(argv[0]) if len(argv) > 0 else 20
+    nr_samples = int(argv[1]) if len(argv) > 1 else 2000
+
+    print '%d series, %d samples each, updates in batches of %d' % (nr_series, nr_samples, BATCH_SIZE)
+    for name in sorted(BACKENDS):
+        try:
+            backend = get_backend(name)
+        except ImportError as e:
+            print '%-8s not available (%s)' % (name, e)
+            continue
+
+        for grouped in (False, True):
+            directory = tempfile.mkdtemp(prefix='farmcontrol-ts-')
+            try:
+                create_s, update_s, fetch_s, last_s = run(backend, directory, nr_series, nr_samples, grouped)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+
+            print '%-8s %-7s create %.3f s, update %.3f s (%.0f samples/s), fetch %.2f ms/series, ' \
+                  'last %.3f ms/series' % (name, 'grouped' if grouped else 'single', create_s, update_s,
+                                           nr_series * nr_samples / update_s, fetch_s * 1000 / nr_series,
+                                           last_s * 1000 / nr_series)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
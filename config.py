@@ -8,6 +8,16 @@ class Config:
     CUSTOM_CONFIG = 'application.cfg'
     SECRET_KEY = 'secret!'  # remember to install secret key
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
+    # applied to every new connection of a SQLite database file (in this order)
+    SQLITE_PRAGMAS = [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', 5000),  # ms
+        ('mmap_size', 64 * 1024 * 1024)
+    ]
+    # persistent connections kept open (0 opens a new connection for every session)
+    SQLITE_POOL_SIZE = 10
+    SQLITE_POOL_MAX_OVERFLOW = 20
     WTF_CSRF_ENABLED = True
     SHOW_DEBUG_GUI = False
     LANGUAGES = {
@@ -30,6 +40,8 @@ class Config:
     RELAY_BOARD = True
     RELAY_BOARD_PORT = '/dev/ttyACM0'
     RELAY_BOARD_BAUD = 9600
+    RELAY_BOARD_QUERY_TIMEOUT = 30
+    RELAY_STATE_CACHE_SECONDS = 2
 
     TWILIO_SID = None
     TWILIO_TOKEN = None
@@ -38,6 +50,10 @@ class Config:
     # the message does not need say anything, this is just a dummy
     # the point is only to call on users number
     TWILIO_CALL_TWIML = "http://demo.twilio.com/docs/voice.xml"
+    CALL_MAX_ATTEMPTS = 30
+    # call status is checked after CALL_POLL_SECONDS, the interval doubles up to CALL_POLL_MAX_SECONDS
+    CALL_POLL_SECONDS = 3
+    CALL_POLL_MAX_SECONDS = 12
 
     # use with second Twilio account (SMS works for free :))
     TWILIO_SMS_SID = None
@@ -54,10 +70,44 @@ class Config:
     APP_EMAIL_SUBJECT_PREFIX = '[Nardi Farma]'
     APP_ADMIN = None
 
+    # storage engine of sensor time series: 'rrdtool' or 'ring' (memory mapped ring files, requires numpy)
+    TIMESERIES_BACKEND = 'rrdtool'
+    # store all sensors with the same step (emit_every) in one database (see manage.py group_timeseries)
+    RRDTOOL_GROUP_SENSORS = False
     RRDTOOL_DEFAULT_CFS = ['AVERAGE']
+    RRDTOOL_WRITER_QUEUE_SIZE = 10000
+    RRDTOOL_WRITER_BATCH_SIZE = 500
+    RRDTOOL_WRITER_FLUSH_SECONDS = 30
 
     RESTART_FAILED_THREADS = True
 
+    # pool name: (number of workers, max queued tasks)
+    THREAD_POOLS = {
+        'relay': (1, 50),
+        'background': (2, 100)
+    }
+    # seconds to wait for a place in a full pool queue before the task is rejected
+    THREAD_POOL_SUBMIT_TIMEOUT = 5
+
+    # outbound e-mails and SMS are queued in the database, at most NOTIFICATION_BATCH_SIZE are sent at once
+    NOTIFICATION_BATCH_SIZE = 200
+    # a message not sent is retried after NOTIFICATION_RETRY_SECONDS (times the attempts made)
+    NOTIFICATION_RETRY_SECONDS = 60
+    NOTIFICATION_MAX_ATTEMPTS = 10
+    # seconds to collect messages sent together (one SMTP connection)
+    NOTIFICATION_BATCH_WINDOW = 1
+
+    # most values per series in /history.json?points=
+    HISTORY_MAX_POINTS = 5000
+    # rows fetched and serialized at a time by /sensors/<id>/history.json
+    HISTORY_CHUNK_ROWS = 1000
+
+    # seconds to collect sensor updates before they are sent to clients (None sends them one by one)
+    SOCKETIO_SENSOR_UPDATE_WINDOW = 0.25
+
+    # /metrics is open to logged in users and to scrapers sending "Authorization: Bearer <METRICS_TOKEN>"
+    METRICS_TOKEN = None
+
     @staticmethod
     def database_dir(env):
         return os.environ.get(env) or os.path.join(basedir, 'db/')
@@ -82,6 +132,7 @@ class DevelopmentConfig(Config):
     SQLALCHEMY_RECORD_QUERIES = True
 
     RRDTOOL_DATABASE_NAME_TEMPLATE = '%s-%d-dev.rrd'  #
+    RRDTOOL_GROUP_NAME_TEMPLATE = 'sensors-%d-dev.rrd'
     RRDTOOL_DATABASE_RESOLUTIONS = [(1, 1), (2, 2), (30, 7)]  #
 
     ASSETS_AUTO_BUILD = True
@@ -107,6 +158,7 @@ class ProductionConfig(Config):
     DATABASE_DIR = Config.database_dir('DATABASE_DIR')
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(DATABASE_DIR, 'data.sqlite')
     RRDTOOL_DATABASE_NAME_TEMPLATE = '%s-%d.rrd'
+    RRDTOOL_GROUP_NAME_TEMPLATE = 'sensors-%d.rrd'
     RRDTOOL_DATABASE_RESOLUTIONS = [(1, 2), (5, 30), (7, 60), (30, 366)]
 
     SEND_SMS = True
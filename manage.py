@@ -54,6 +54,30 @@ def deploy():
     upgrade()
 
 
+@manager.command
+def group_timeseries():
+    """Copy time series of single sensor databases into one database per step (see RRDTOOL_GROUP_SENSORS)"""
+    from app import rrddb
+
+    by_step = {}
+    for s in Sensor.query.all():
+        rrddef = s.get_rrd_definition()
+        rrddef.path = os.path.join(app.config['DATABASE_DIR'],
+                                   app.config['RRDTOOL_DATABASE_NAME_TEMPLATE'] % (s.sensor_code, s.emit_every))
+        if s.emit_every and rrddb.is_rrd_initialized(rrddef):
+            by_step.setdefault(s.emit_every, []).append(rrddef)
+
+    for step, rrddefs in sorted(by_step.items()):
+        path = os.path.join(app.config['DATABASE_DIR'], app.config['RRDTOOL_GROUP_NAME_TEMPLATE'] % (step,))
+        print 'Copying', ', '.join(r.name for r in rrddefs), 'into', path
+        try:
+            print rrddb.copy_into(rrddefs, path, step), 'rows written'
+        except rrddb.RrdDefinitionException as e:
+            print 'Skipped:', e
+
+    print 'Set RRDTOOL_GROUP_SENSORS = True in the configuration to use the new databases'
+
+
 @manager.command
 def create_db():
     print app.config['SQLALCHEMY_DATABASE_URI']
@@ -88,11 +112,12 @@ def runserver():
     install_secret_key()
     app.logger.info('Starting with socketio-gevent')
 
-    from app.dashboard.views import start_routines
+    from app.dashboard.views import start_routines, stop_routines
 
     start_routines()
     socketio.run(app)
     app.logger.info('Stopping socketio-gevent')
+    stop_routines()
 
 
 if __name__ == '__main__':